@@ -1,105 +1,293 @@
 """ Логика взаимодействия с api OMDb """
 
 import asyncio
+import logging
 import time
 from configparser import ConfigParser
-from typing import Union
+from typing import List, Optional, Union
 
 import aiohttp
+import cache
+import catalog
+import instrumentation
+import metrics
 import mparser
+import omdb_keys
+import suggest
+from movie import Movie
 
 config = ConfigParser()
 config.read('config.ini')
-API_TOKEN = config['ombd']['api_key']
+url = config.get('ombd', 'url', fallback='http://www.omdbapi.com/')
 
-url = 'http://www.omdbapi.com/'
+# Настройки пула соединений к OMDb
+TIMEOUT = config.getfloat('ombd', 'timeout', fallback=10)
+CONNECT_TIMEOUT = config.getfloat('ombd', 'connect_timeout', fallback=3)
+POOL_LIMIT = config.getint('ombd', 'pool_limit', fallback=100)
+POOL_LIMIT_PER_HOST = config.getint('ombd', 'pool_limit_per_host', fallback=20)
+KEEPALIVE_TIMEOUT = config.getfloat('ombd', 'keepalive_timeout', fallback=30)
+DNS_CACHE_TTL = config.getint('ombd', 'dns_cache_ttl', fallback=300)
+
+NOT_FOUND_ERRORS = ('Movie not found!', 'Incorrect IMDb ID.')
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+_in_flight = {}  # ключ запроса -> задача, выполняющая запрос к OMDb
+
+upstream_calls = metrics.counter('omdb_upstream_calls_total', 'Запросы к OMDb')
+catalog_hits = metrics.counter('catalog_hits_total',
+                               'Фильмы, найденные по локальному каталогу без поиска по названию в OMDb')
+coalesced_calls = metrics.counter('omdb_coalesced_calls_total',
+                                  'Запросы, дождавшиеся уже выполняющегося запроса к OMDb с тем же ключом')
+
+
+async def start_session() -> aiohttp.ClientSession:
+    """ Создание общей сессии для запросов к OMDb.
+        Сессия живет все время работы бота и переиспользует соединения
+    """
+
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT,
+                                         limit_per_host=POOL_LIMIT_PER_HOST,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         use_dns_cache=True,
+                                         ttl_dns_cache=DNS_CACHE_TTL)
+        timeout = aiohttp.ClientTimeout(total=TIMEOUT, connect=CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session() -> None:
+    """ Закрытие общей сессии при остановке бота """
+
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
 
 async def search_movie_data(movie_title: str, year: Union[str, None] = 'empty') -> dict:  # в 3.9 нет |
     """ Запрос к api для получения информации о фильме """
 
-    params = {
-        't': movie_title,  # i по айди фильма
-        'apikey': API_TOKEN,
+    key = cache.movie_key(movie_title, year)
+    found, film = cache.movies.peek(key)
+    if found:
+        return make_answer(film)
+    return await single_flight(key, lambda: lookup_movie(key, movie_title, year))
+
+
+async def lookup_movie(key: str, movie_title: str, year: Union[str, None] = 'empty') -> dict:
+    """ Поиск фильма, которого нет в кэше в памяти: таблицы кэша, затем локальный каталог и OMDb """
+
+    found, film = await cache.movies.load(key)
+    if found:
+        return make_answer(film)
+    return await resolve_movie(key, movie_title, year)
+
+
+async def single_flight(key: str, factory) -> dict:
+    """ Одновременные запросы с одинаковым ключом ждут один поиск (база, каталог, OMDb) и получают его результат.
+        Отмена одного из ожидающих не отменяет запрос для остальных
+    """
+
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _in_flight[key] = task
+        task.add_done_callback(lambda done: _forget(key, done))
+    else:
+        coalesced_calls.inc()
+    answer = await asyncio.shield(task)
+    return dict(answer)
+
+
+def _forget(key: str, task: asyncio.Future) -> None:
+    """ Удаление завершенного запроса. Ошибка забирается, даже если результат уже никто не ждет """
+
+    if _in_flight.get(key) is task:
+        del _in_flight[key]
+    if not task.cancelled():
+        task.exception()
+
+
+async def search_movie_by_id(imdb_id: str) -> dict:
+    """ Поиск фильма по imdbID: сначала кэш и таблица film, затем OMDb по параметру i """
+
+    film = cache.movies.films.get(imdb_id)
+    if film is not None:
+        return make_answer(film)
+    key = cache.movie_key(imdb_id)
+    return await single_flight(key, lambda: lookup_movie_by_id(key, imdb_id))
+
+
+async def lookup_movie_by_id(key: str, imdb_id: str) -> dict:
+    """ Поиск по imdbID, которого нет в кэше в памяти: таблица film, отметка об отсутствии фильма, OMDb """
+
+    film = await cache.movies.get_by_imdb_id(imdb_id)
+    if film is not None:
+        return make_answer(film)
+    found, film = await cache.movies.get(key)  # imdbID, которого нет в OMDb
+    if found:
+        return make_answer(film)
+    return await fetch_movie_by_id_data(key, imdb_id)
+
+
+async def resolve_movie(key: str, movie_title: str, year: Union[str, None] = 'empty') -> dict:
+    """ Поиск фильма, которого нет в кэше: imdbID по локальному каталогу, иначе поиск по названию в OMDb """
+
+    imdb_id = await catalog.find(movie_title, year)
+    if imdb_id is not None:
+        film = await cache.movies.get_by_imdb_id(imdb_id)
+        if film is None:
+            film = await fetch_movie_by_id(imdb_id)
+        if film is not None:
+            catalog_hits.inc()
+            await cache.movies.set(key, film)
+            suggest.titles.add(film.imdb_id, film.title, film.year, names=(movie_title,))
+            return make_answer(film)
+    return await fetch_movie_data(key, movie_title, year)
+
+
+async def omdb_request(params: dict) -> Optional[dict]:
+    """ Запрос к OMDb ключом из пула. Если ключ исчерпал лимит или неверен, запрос повторяется другим ключом.
+        None - нет доступных ключей, ошибка сети или ответ не 200
+    """
+
+    session = await start_session()  # Если сессия еще не создана, например при запуске без бота
+    query = params.get('t') or params.get('i')
+    while True:
+        api_key = await omdb_keys.pool.acquire()
+        if api_key is None:
+            logger.warning('Нет доступных ключей OMDb', extra={'query': query})
+            return None
+        upstream_calls.inc()
+        try:
+            with instrumentation.phase('omdb'):
+                async with session.get(url, params=dict(params, apikey=api_key.value)) as response:
+                    status = response.status
+                    # Ошибки ключа и лимита приходят с кодом 401 и описанием в Error
+                    data = await response.json(content_type=None) if status in (200, 401) else None
+        except asyncio.TimeoutError as e:
+            api_key.slow_down()
+            logger.warning('Ошибка запроса к OMDb: %r', e, extra={'query': query, 'key': api_key.label})
+            return None
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning('Ошибка запроса к OMDb: %r', e, extra={'query': query, 'key': api_key.label})
+            return None
+        if omdb_keys.pool.report(api_key, status, data.get('Error') if data else None):
+            continue
+        # Почему-то всегда возвращает 200, даже если фильма нет, обрабатываю на response
+        if status != 200:
+            logger.warning('OMDb ответил со статусом %s', status, extra={'query': query, 'key': api_key.label})
+            return None
+        return data
+
+
+async def fetch_movie_data(key: str, movie_title: str, year: Union[str, None] = 'empty') -> dict:
+    """ Запрос к OMDb по названию и сохранение ответа в кэш """
+
+    data = await omdb_request({
+        't': movie_title,
         'plot': 'full',
         'type': 'movie',
         'y': year
-    }
+    })
+    return await store_response(key, data, names=(movie_title,))
+
+
+async def fetch_movie_by_id_data(key: str, imdb_id: str) -> dict:
+    """ Запрос к OMDb по imdbID и сохранение ответа в кэш """
+
+    return await store_response(key, await omdb_request({'i': imdb_id, 'plot': 'full'}))
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data['Response'] == 'True':
-                    answer = {
-                        'data': convert_to_txt(data),
-                        'imdbID': data['imdbID'],
-                        'response': True,
-                        'error': None,
-                        'poster': data['Poster']
-                    }
-                    return answer
-                else:
-                    return {'error': 'Фильм не найден',
-                            'response': False
-                            }
-            else:  # Почему-то всегда возвращает 200, даже если фильма нет, обрабатываю на response
-                return {'error': 'Movie not found or API error',
-                        'response': False}
+
+async def store_response(key: str, data: Optional[dict], names: tuple = ()) -> dict:
+    """ Сохранение ответа OMDb в кэш и индекс подсказок, names - названия, по которым искали фильм """
+
+    if data is None:
+        return {'error': 'Movie not found or API error',
+                'response': False}
+
+    if data['Response'] == 'True':
+        film = Movie.from_omdb(data)
+        await cache.movies.set(key, film)
+        suggest.titles.add(film.imdb_id, film.title, film.year, names=names)
+        return make_answer(film)
+    if data.get('Error') in NOT_FOUND_ERRORS:  # Ошибки ключа и лимита не кэшируются
+        await cache.movies.set(key, None)
+    else:
+        logger.warning('OMDb вернул ошибку: %s', data.get('Error'), extra={'key': key})
+    return make_answer(None)
+
+
+async def fetch_movie_by_id(imdb_id: str) -> Optional[Movie]:
+    """ Запрос к OMDb по imdbID. None - фильм не найден или ошибка запроса """
+
+    data = await omdb_request({'i': imdb_id, 'plot': 'full'})
+    if data is None or data.get('Response') != 'True':
+        return None
+    return Movie.from_omdb(data)
+
+
+def make_answer(film: Optional[Movie]) -> dict:
+    """ Ответ для бота. film = None - фильм не найден """
+
+    if film is None:
+        return {'error': 'Фильм не найден',
+                'response': False
+                }
+    answer = {
+        'data': film.text,
+        'imdbID': film.imdb_id,
+        'response': True,
+        'error': None,
+        'poster': film.poster,
+        'caption': film.caption
+    }
+    return answer
 
 
 def convert_to_txt(data: dict) -> str:
-    """ Форматирование в текстовый вид """
-
-    imd = 'N/A'
-    rotten_tomatos = 'N/A'
-    metacritic = 'N/A'
-    try:
-        imd = data['Ratings'][0]['Value']
-        rotten_tomatos = data['Ratings'][1]['Value']
-        metacritic = data['Ratings'][2]['Value']
-    except IndexError as _:
-        pass
-
-    text = (
-        f'Название: {data.get("Title", "N/A")}\n'
-        f'Описание: {data.get("Plot", "N/A")}\n'  
-        f'Тип: {data.get("Type", "N/A")}\n'
-        f'Возрастной рейтинг: {data.get("Rated", "N/A")}\n'
-        f'Релиз: {data.get("Released", "N/A")}\n'
-        f'Длительность: {data.get("Runtime", "N/A")}\n'
-        f'Жанр: {data.get("Genre", "N/A")}\n'
-        f'Режиссер: {data.get("Director", "N/A")}\n'
-        f'Сценарий: {data.get("Writer", "N/A")}\n'
-        f'Актеры: {data.get("Actors", "N/A")}\n'
-        f'Страна: {data.get("Country", "N/A")}\n'
-        f'Награды: {data.get("Awards", "N/A")}\n'
-        f'Сборы: {data.get("BoxOffice", "N/A")}\n'
-        f'Постер: {data.get("Poster", "N/A")}\n'
-        f'Рейтинг:\n'
-        f'  IMD: {imd}\n'
-        f'  Rotten Tomatoes: {rotten_tomatos}\n'
-        f'  Metacritic: {metacritic}\n'
-    )
-
-    return text
-
-
-async def get_random_film():
-    """ Выдает информацию о случайном фильме """
-
-    while True:  # Цикл для повторных попыток
-        title = mparser.parse_movie_info()  # Получаем случайное название фильма
-        info = await search_movie_data(title)  # Ищем информацию о фильме
-        poster = info.get('poster', None)
-        if poster is None:
-            print('Повторяю попытку, нет постера')
-            await asyncio.sleep(1)  # Используем await для асинхронного ожидания
-            continue  # Если произошла ошибка, повторяем попытку
-
-        if info['error'] is not None:
-            print('Повторяю попытку, фильм не найден')
-            await asyncio.sleep(1)
-            continue
+    """ Форматирование ответа OMDb в текстовый вид """
+
+    return Movie.from_omdb(data).text
+
+
+def is_good_random_film(info: dict) -> bool:
+    """ Подходит ли фильм для выдачи как случайный: найден в OMDb и есть постер """
+
+    if info['error'] is not None:
+        logger.debug('Повторяю попытку, фильм не найден')
+        return False
+    if info.get('poster') in (None, 'N/A'):
+        logger.debug('Повторяю попытку, нет постера')
+        return False
+    return True
+
+
+async def find_random_films(count: int) -> List[dict]:
+    """ Несколько попыток найти случайный фильм параллельно. В списке только подходящие фильмы """
+
+    titles = await mparser.fetch_movie_titles(count)  # Получаем случайные названия фильмов
+    infos = await asyncio.gather(*(search_movie_data(title) for title in titles))  # Ищем информацию о фильмах
+    return [info for info in infos if is_good_random_film(info)]
+
+
+async def find_random_film() -> Optional[dict]:
+    """ Одна попытка найти случайный фильм. None, если фильм не найден или у него нет постера """
+
+    films = await find_random_films(1)
+    return films[0] if films else None
+
+
+async def get_random_film(attempts: int = 10) -> Optional[dict]:
+    """ Выдает информацию о случайном фильме. None, если за attempts попыток фильм не найден """
 
-        return info
+    for _ in range(attempts):  # Цикл для повторных попыток
+        info = await find_random_film()
+        if info is not None:
+            return info
+        await asyncio.sleep(1)  # Используем await для асинхронного ожидания
+    return None
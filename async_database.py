@@ -0,0 +1,286 @@
+""" Асинхронный доступ к базе данных Postgresql.
+    Функции database выполняются в ограниченном пуле потоков,
+    чтобы ожидание ответа базы не блокировало обработку сообщений других пользователей
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+from telegram import _user
+
+import database
+import instrumentation
+
+config = ConfigParser()
+config.read('config.ini')
+DB_WORKERS = config.getint('postgresql', 'workers', fallback=10)
+MAILING_BATCH_SIZE = config.getint('mailing', 'batch_size', fallback=1000)
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='database')
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """ Выполнение синхронной функции работы с базой в пуле потоков """
+
+    loop = asyncio.get_running_loop()
+    with instrumentation.phase('database'):
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown() -> None:
+    """ Остановка пула потоков с ожиданием завершения начатых запросов """
+
+    _executor.shutdown(wait=True)
+
+
+def _add_user_whitelist(user: _user) -> database.User:
+    with database.session_local() as db_sess:
+        return database.add_user_whitelist(db_sess, user)
+
+
+async def add_user_whitelist(user: _user) -> database.User:
+    """ Добавление пользователя в белый лист """
+
+    return await run(_add_user_whitelist, user)
+
+
+async def is_user_in_whitelist(telegram_id: int) -> bool:
+    """ Проверка наличия пользователя в белом листе """
+
+    return await run(database.is_user_in_whitelist, telegram_id)
+
+
+async def add_request(user: _user, imdb_id: str, date_time: datetime) -> database.Request:
+    """ Добавление записи в request """
+
+    return await run(database.add_request, user, imdb_id, date_time)
+
+
+async def add_bad_request(user: _user, title, date_time: datetime, error: str) -> None:
+    """ Добавление записи в bad_request и обновление поля last_request у user """
+
+    return await run(database.add_bad_request, user, title, date_time, error)
+
+
+async def requests_since(since: datetime) -> list:
+    """ Успешные запросы начиная с since: список (id пользователя, дата и время) """
+
+    return await run(database.requests_since, since)
+
+
+async def write_request_log(requests: list, bad_requests: list, last_requests: dict) -> None:
+    """ Запись накопленных запросов одной транзакцией """
+
+    return await run(database.write_request_log, requests, bad_requests, last_requests)
+
+
+async def update_last_request(user: _user, date_time: datetime) -> None:
+    """ Обновление поля last_request у user """
+
+    return await run(database.update_last_request, user, date_time)
+
+
+async def update_user_mailing(user: _user) -> bool:
+    """ Включение/выключение рассылки у user """
+
+    return await run(database.update_user_mailing, user)
+
+
+async def view_all_sub() -> dict:
+    """ Все доступные подписки """
+
+    return await run(database.view_all_sub)
+
+
+async def get_max_request(user: _user) -> int:
+    """ Максимальное количество запросов в сутки пользователя """
+
+    return await run(database.get_max_request, user)
+
+
+async def get_sub_user(user: _user) -> tuple:
+    """ Информация о подписке пользователя """
+
+    return await run(database.get_sub_user, user)
+
+
+async def get_user_info(telegram_id: int) -> Optional[tuple]:
+    """ Информация о пользователе и его подписке """
+
+    return await run(database.get_user_info, telegram_id)
+
+
+async def get_all_users_info() -> list:
+    """ Информация о всех пользователях белого листа """
+
+    return await run(database.get_all_users_info)
+
+
+async def amount_request_user(user: _user) -> int:
+    """ Информация о количестве запросов пользователя за эти сутки """
+
+    return await run(database.amount_request_user, user)
+
+
+async def amount_request_for_day() -> int:
+    """ Количество выполненных запросов за последние сутки """
+
+    return await run(database.amount_request_for_day)
+
+
+async def top_films(since: date, limit: int = 10) -> list:
+    """ Самые запрашиваемые фильмы начиная с дня since """
+
+    return await run(database.top_films, since, limit)
+
+
+async def get_info_sub(name: str) -> database.Subscription:
+    """ Информация о подписке по ее названию """
+
+    return await run(database.get_info_sub, name)
+
+
+async def users_id_with_mailing() -> list:
+    """ Список telegram id пользователей у которых есть рассылка """
+
+    return await run(database.users_id_with_mailing)
+
+
+async def iter_users_id_with_mailing(batch_size: int = MAILING_BATCH_SIZE) -> AsyncIterator[List[int]]:
+    """ Пачки telegram id пользователей с рассылкой.
+        Пользователи читаются постранично по id, следующая пачка загружается, пока обрабатывается текущая
+    """
+
+    next_batch = asyncio.ensure_future(run(database.users_id_with_mailing_batch, 0, batch_size))
+    try:
+        while True:
+            rows = await next_batch
+            if len(rows) == batch_size:
+                next_batch = asyncio.ensure_future(run(database.users_id_with_mailing_batch, rows[-1][0], batch_size))
+            else:
+                next_batch = None
+            if rows:
+                yield [telegram_id for _, telegram_id in rows]
+            if next_batch is None:
+                return
+    finally:
+        if next_batch is not None and not next_batch.done():
+            next_batch.cancel()
+
+
+async def get_movie_cache(key: str):
+    """ Актуальная запись кэша по нормализованному названию и году """
+
+    return await run(database.get_movie_cache, key)
+
+
+async def get_film(imdb_id: str):
+    """ Актуальный фильм по imdbID """
+
+    return await run(database.get_film, imdb_id)
+
+
+async def set_film(imdb_id: str, data: dict, expires_at: datetime) -> None:
+    """ Добавление или обновление фильма """
+
+    return await run(database.set_film, imdb_id, data, expires_at)
+
+
+async def set_movie_cache(key: str, imdb_id: Optional[str], data: Optional[dict], expires_at: datetime) -> None:
+    """ Добавление или обновление записи кэша """
+
+    return await run(database.set_movie_cache, key, imdb_id, data, expires_at)
+
+
+async def delete_expired_movie_cache() -> int:
+    """ Удаление устаревших записей кэша и фильмов """
+
+    return await run(database.delete_expired_movie_cache)
+
+
+async def get_poster_file_id(imdb_id: str) -> Optional[str]:
+    """ file_id постера фильма в Telegram """
+
+    return await run(database.get_poster_file_id, imdb_id)
+
+
+async def set_poster_file_id(imdb_id: str, file_id: str) -> None:
+    """ Добавление или обновление file_id постера """
+
+    return await run(database.set_poster_file_id, imdb_id, file_id)
+
+
+async def delete_poster_file_id(imdb_id: str) -> None:
+    """ Удаление file_id, который Telegram больше не принимает """
+
+    return await run(database.delete_poster_file_id, imdb_id)
+
+
+async def get_omdb_key_usage(day: date) -> dict:
+    """ Запросы ключей OMDb за сутки """
+
+    return await run(database.get_omdb_key_usage, day)
+
+
+async def save_omdb_key_usage(rows: list) -> None:
+    """ Сохранение счетчиков ключей OMDb """
+
+    return await run(database.save_omdb_key_usage, rows)
+
+
+async def create_mailing_run(imdb_id: str, text: str) -> int:
+    """ Создание новой рассылки """
+
+    return await run(database.create_mailing_run, imdb_id, text)
+
+
+async def get_unfinished_mailing_run() -> Optional[database.MailingRun]:
+    """ Последняя незавершенная рассылка """
+
+    return await run(database.get_unfinished_mailing_run)
+
+
+async def finish_mailing_run(run_id: int) -> None:
+    """ Отметка о завершении рассылки """
+
+    return await run(database.finish_mailing_run, run_id)
+
+
+async def add_mailing_deliveries(run_id: int, deliveries: list) -> None:
+    """ Сохранение результатов отправки рассылки """
+
+    return await run(database.add_mailing_deliveries, run_id, deliveries)
+
+
+async def delivered_telegram_ids(run_id: int, telegram_ids: list) -> set:
+    """ Telegram id из списка, которым рассылка уже обработана """
+
+    return await run(database.delivered_telegram_ids, run_id, telegram_ids)
+
+
+async def disable_mailing(telegram_ids: list) -> None:
+    """ Выключение рассылки у пользователей, заблокировавших бота """
+
+    return await run(database.disable_mailing, telegram_ids)
+
+
+async def cached_titles() -> list:
+    """ Найденные фильмы из movie_cache """
+
+    return await run(database.cached_titles)
+
+
+async def request_counts() -> dict:
+    """ Количество успешных запросов каждого фильма """
+
+    return await run(database.request_counts)
+
+
+async def find_catalog_title(normalized_title: str, year: Optional[int] = None) -> list:
+    """ Фильмы локального каталога с таким названием, самые популярные первыми """
+
+    return await run(database.find_catalog_title, normalized_title, year)
@@ -0,0 +1,131 @@
+""" Сравнение Movie с прежним хранением ответа OMDb в кэше.
+    Запуск из корня проекта: python benchmarks/bench_movie.py [--films 1000] [--repeat 5]
+
+    Замеряется память на один фильм в кэше: прежде кэш хранил весь ответ OMDb,
+    теперь - Movie с готовым текстом ответа. И время получения текста ответа:
+    прежде текст собирался из ответа OMDb при каждом обращении, теперь - один раз на imdbID
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import timeit
+import tracemalloc
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from movie import Movie  # noqa: E402
+
+FIXTURES = sorted((ROOT / 'benchmarks' / 'fixtures').glob('omdb_*.json'))
+
+
+def legacy_convert_to_txt(data: dict) -> str:
+    """ Форматирование как в прежней api.convert_to_txt """
+
+    imd = 'N/A'
+    rotten_tomatos = 'N/A'
+    metacritic = 'N/A'
+    try:
+        imd = data['Ratings'][0]['Value']
+        rotten_tomatos = data['Ratings'][1]['Value']
+        metacritic = data['Ratings'][2]['Value']
+    except IndexError as _:
+        pass
+
+    text = (
+        f'Название: {data.get("Title", "N/A")}\n'
+        f'Описание: {data.get("Plot", "N/A")}\n'
+        f'Тип: {data.get("Type", "N/A")}\n'
+        f'Возрастной рейтинг: {data.get("Rated", "N/A")}\n'
+        f'Релиз: {data.get("Released", "N/A")}\n'
+        f'Длительность: {data.get("Runtime", "N/A")}\n'
+        f'Жанр: {data.get("Genre", "N/A")}\n'
+        f'Режиссер: {data.get("Director", "N/A")}\n'
+        f'Сценарий: {data.get("Writer", "N/A")}\n'
+        f'Актеры: {data.get("Actors", "N/A")}\n'
+        f'Страна: {data.get("Country", "N/A")}\n'
+        f'Награды: {data.get("Awards", "N/A")}\n'
+        f'Сборы: {data.get("BoxOffice", "N/A")}\n'
+        f'Постер: {data.get("Poster", "N/A")}\n'
+        f'Рейтинг:\n'
+        f'  IMD: {imd}\n'
+        f'  Rotten Tomatoes: {rotten_tomatos}\n'
+        f'  Metacritic: {metacritic}\n'
+    )
+
+    return text
+
+
+def make_responses(count: int) -> list:
+    """ Тексты разных ответов OMDb. Память замеряется при разборе текста, как при получении ответа """
+
+    samples = [json.loads(path.read_text(encoding='utf-8')) for path in FIXTURES]
+    responses = []
+    for i in range(count):
+        data = dict(samples[i % len(samples)], imdbID=f'tt{i:07d}')
+        data['Title'] = f'{data["Title"]} {i}'
+        responses.append(json.dumps(data))
+    return responses
+
+
+def allocated(build) -> int:
+    """ Память, занятая объектами, которые вернула build """
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = build()  # noqa: F841 - объекты должны жить до второго снимка
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+
+def bench_memory(responses: list) -> None:
+    raw = allocated(lambda: [json.loads(text) for text in responses])
+    films = allocated(lambda: [Movie.from_omdb(json.loads(text)) for text in responses])
+
+    def with_text():
+        result = [Movie.from_omdb(json.loads(text)) for text in responses]
+        for film in result:
+            film.text  # noqa: B018 - текст хранится в записи
+        return result
+
+    rendered = allocated(with_text)
+    count = len(responses)
+    print(f'Память на фильм: ответ OMDb {raw / count:.0f} Б | Movie {films / count:.0f} Б | '
+          f'Movie с текстом ответа {rendered / count:.0f} Б')
+
+
+def bench_render(responses: list, repeat: int) -> None:
+    responses = [json.loads(text) for text in responses]
+    films = [Movie.from_omdb(data) for data in responses]
+    for film in films:
+        film.text  # noqa: B018
+
+    def per_call(func) -> float:
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat=repeat, number=number)) / number / len(responses)
+
+    legacy = per_call(lambda: [legacy_convert_to_txt(data) for data in responses])
+    first = per_call(lambda: [Movie.from_omdb(data).text for data in responses])
+    cached = per_call(lambda: [film.text for film in films])
+    print(f'Текст ответа: прежнее форматирование {legacy * 1e6:.2f} мкс | '
+          f'разбор и форматирование {first * 1e6:.2f} мкс | '
+          f'повторное обращение {cached * 1e6:.3f} мкс | ускорение x{legacy / cached:.0f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--films', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    responses = make_responses(args.films)
+    bench_memory(responses)
+    bench_render(responses, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+""" Сравнение скорости парсера randomfilm с прежней реализацией.
+    Запуск из корня проекта: python benchmarks/bench_mparser.py [--count 50] [--repeat 200]
+
+    Замеряется время разбора сохраненных страниц из benchmarks/fixtures
+    и количество названий в секунду при загрузке с локального HTTP сервера
+"""
+
+import argparse
+import asyncio
+import itertools
+import pathlib
+import sys
+import time
+import timeit
+
+import requests
+from aiohttp import web
+from bs4 import BeautifulSoup
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import mparser  # noqa: E402
+
+FIXTURES = sorted((ROOT / 'benchmarks' / 'fixtures').glob('randomfilm_*.html'))
+
+
+def legacy_parse(content: bytes):
+    """ Разбор страницы как в прежней mparser.parse_movie_info """
+
+    soup = BeautifulSoup(content, 'html.parser')
+    title_element = soup.find('h2')
+    if title_element:
+        title = title_element.text.strip()
+        parts = title.split('/')
+        if len(parts) > 1:
+            return parts[1].strip()
+        return title
+    return
+
+
+def legacy_fetch(url: str):
+    """ Загрузка как в прежней mparser.parse_movie_info """
+
+    response = requests.get(url)
+    if response.status_code != 200:
+        return None
+    return legacy_parse(response.content)
+
+
+def bench_parse(repeat: int) -> None:
+    for path in FIXTURES:
+        content = path.read_bytes()
+        html = content.decode('utf-8')
+        assert legacy_parse(content) == mparser.parse_title(html), path.name
+        legacy = min(timeit.repeat(lambda: legacy_parse(content), number=1, repeat=repeat))
+        targeted = min(timeit.repeat(lambda: mparser.parse_title(html), number=1, repeat=repeat))
+        print(f'{path.name}: прежний разбор {legacy * 1000:.3f} мс | '
+              f'разбор фрагмента {targeted * 1000:.3f} мс | ускорение x{legacy / targeted:.1f}')
+
+
+async def start_server() -> tuple:
+    """ Локальный сервер, по очереди отдающий сохраненные страницы """
+
+    pages = itertools.cycle([path.read_bytes() for path in FIXTURES])
+
+    async def handler(request):
+        return web.Response(body=next(pages), content_type='text/html', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}/'
+
+
+async def bench_fetch(count: int) -> None:
+    runner, url = await start_server()
+    mparser.URL = url
+    try:
+        start = time.perf_counter()
+        titles = await asyncio.to_thread(lambda: [legacy_fetch(url) for _ in range(count)])
+        legacy = time.perf_counter() - start
+        assert all(titles)
+
+        await mparser.start_session()
+        start = time.perf_counter()
+        titles = await mparser.fetch_movie_titles(count)
+        current = time.perf_counter() - start
+        assert len(titles) == count
+    finally:
+        await mparser.close_session()
+        await runner.cleanup()
+    print(f'{count} названий: прежняя загрузка {count / legacy:.1f} названий/с | '
+          f'асинхронная загрузка ({mparser.CONCURRENCY} параллельно) {count / current:.1f} названий/с')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=50, help='Количество загружаемых названий')
+    parser.add_argument('--repeat', type=int, default=200, help='Количество повторов разбора страницы')
+    args = parser.parse_args()
+
+    bench_parse(args.repeat)
+    asyncio.run(bench_fetch(args.count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+""" Нагрузочная проверка ChatOrderedUpdateProcessor.
+    Запуск из корня проекта: python benchmarks/stress_update_processor.py [--chats 200] [--per-chat 10]
+
+    Обновления подаются так же, как это делает Application: задача на каждое обновление
+    в порядке поступления. Обработчик имитирует ожидание OMDb и базы данных.
+    Проверяется, что пропускная способность растет с лимитом параллельности,
+    а сообщения каждого чата обработаны в порядке отправки
+"""
+
+import argparse
+import asyncio
+import datetime
+import pathlib
+import random
+import sys
+import time
+
+from telegram import Chat, Message, Update, User
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from update_processor import ChatOrderedUpdateProcessor  # noqa: E402
+
+
+def make_updates(chats: int, per_chat: int) -> list:
+    """ Обновления от нескольких чатов, перемешанные между собой, но по порядку внутри чата """
+
+    date = datetime.datetime.now(datetime.timezone.utc)
+    queues = {chat_id: list(range(per_chat)) for chat_id in range(1, chats + 1)}
+    updates = []
+    update_id = 0
+    while queues:
+        chat_id = random.choice(list(queues))
+        number = queues[chat_id].pop(0)
+        if not queues[chat_id]:
+            del queues[chat_id]
+        update_id += 1
+        user = User(chat_id, f'user{chat_id}', False)
+        message = Message(update_id, date, Chat(chat_id, Chat.PRIVATE), from_user=user, text=str(number))
+        updates.append(Update(update_id, message=message))
+    return updates
+
+
+async def run(concurrency: int, updates: list, delay: float) -> tuple:
+    """ Обработка всех обновлений, возвращает (обновлений в секунду, порядок сохранен) """
+
+    processor = ChatOrderedUpdateProcessor(concurrency)
+    processed = {}
+
+    async def handle(update: Update) -> None:
+        await asyncio.sleep(random.uniform(0, 2 * delay))
+        processed.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+
+    start = time.perf_counter()
+    async with processor:
+        tasks = [asyncio.create_task(processor.process_update(update, handle(update))) for update in updates]
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    ordered = all(numbers == sorted(numbers) for numbers in processed.values())
+    return len(updates) / elapsed, ordered
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--per-chat', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0.01, help='Среднее время обработки обновления, секунд')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    random.seed(1)
+    updates = make_updates(args.chats, args.per_chat)
+    results = []
+    for concurrency in args.concurrency:
+        throughput, ordered = await run(concurrency, updates, args.delay)
+        results.append(throughput)
+        print(f'Параллельно {concurrency:>3}: {throughput:8.1f} обновлений/с | '
+              f'порядок в чатах {"сохранен" if ordered else "НАРУШЕН"}')
+        if not ordered:
+            sys.exit(1)
+    if results != sorted(results):
+        print('Пропускная способность не растет с лимитом параллельности')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
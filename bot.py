@@ -1,38 +1,96 @@
 """  Основная логика работы телеграм бота """
+import asyncio
+import contextlib
+import functools
+import logging
+import re
+
 import pytz
 import api
 import datetime
 from configparser import ConfigParser
-from telegram import Update
-from telegram.ext import (ApplicationBuilder,
+from typing import Optional, Tuple
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.ext import (Application,
+                          ApplicationBuilder,
                           ContextTypes,
                           filters,
                           CommandHandler,
+                          InlineQueryHandler,
                           MessageHandler, CallbackContext)
+import async_database
+import cache
 import database
+import logs
+import mailing
+import metrics
+import mparser
+import omdb_keys
+import posters
+import prefetch
+import quota
+import request_log
+import rollup
+import suggest
+import webhook
+import whitelist
+from instrumentation import InstrumentedRequest, instrument
+from update_processor import ChatOrderedUpdateProcessor
 
 config = ConfigParser()
 config.read('config.ini')
 TELEGRAM_BOT_TOKEN = config['telegram']['bot_token']
 ACTIVATION_CODE = config['activation']['code']
+MODE = config.get('telegram', 'mode', fallback='polling')  # polling или webhook
+BASE_URL = config.get('telegram', 'base_url', fallback='https://api.telegram.org/bot')  # Другой адрес Bot API
+CONCURRENT_UPDATES = config.getint('telegram', 'concurrent_updates', fallback=32)  # 1 - обработка по одному
+INSTANCE_WAIT = 10  # Секунд между попытками запуска, пока работает другой процесс бота
 moscow_tz = pytz.timezone('Europe/Moscow')
 
+IMDB_LINK = re.compile(r'imdb\.com/(?:[a-z]{2}/)?title/(tt\d{7,10})', re.IGNORECASE)
+IMDB_ID = re.compile(r'tt\d{7,10}', re.IGNORECASE)
+
+logger = logging.getLogger('bot')
+cache_stats = metrics.gauge('bot_cache', 'Счетчики кэшей: размер, попадания, промахи', ('cache', 'stat'))
+
+
+user_locks = {}  # telegram id -> блокировка проверки лимита, пока ее держит или ждет хотя бы одно сообщение
+_user_lock_waiters = {}  # telegram id -> количество сообщений, держащих или ждущих блокировку
+
+
+@contextlib.asynccontextmanager
+async def user_lock(telegram_id: int):
+    """ Блокировка пользователя. Удаляется, когда ее никто не ждет, поэтому user_locks не растет """
+
+    lock = user_locks.get(telegram_id)
+    if lock is None:
+        lock = user_locks[telegram_id] = asyncio.Lock()
+        _user_lock_waiters[telegram_id] = 0
+    _user_lock_waiters[telegram_id] += 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _user_lock_waiters[telegram_id] -= 1
+        if not _user_lock_waiters[telegram_id]:
+            del _user_lock_waiters[telegram_id]
+            del user_locks[telegram_id]
+
 
 def check_user(func):
     """ Декоратор, проверяющий наличие пользователя в белом листе """
 
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if database.is_user_in_whitelist(update.effective_user.id):
+        if await whitelist.users.get(update.effective_user.id) is not None:
             return await func(update, context)
         else:
             await update.message.reply_text('Для доступа к боту, отправьте команду /activate <код>')
-            date_time = datetime.datetime.now()
-            output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-                     f'Запрос неавторизованного пользователя'
-            print(output)
+            logger.info('Запрос неавторизованного пользователя', extra={'user_id': update.effective_user.id})
     return wrapper
 
 
+@instrument('start')
 @check_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /start
@@ -41,12 +99,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     await update.message.reply_text('Введите название фильма для поиска. '
                                     'Для более точного поиска можете ввести и год выпуска')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/start'
-    print(output)
+    logger.info('/start', extra={'user_id': update.effective_user.id})
 
 
+@instrument('activate')
 async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /activate
         Добавляет пользователя в базу данных, для использования бота
@@ -55,18 +111,17 @@ async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     code = context.args[0] if context.args else None
     if code == ACTIVATION_CODE:
         user = update.effective_user
-        if not database.is_user_in_whitelist(user.id):
-            db_sess = database.session_local()
+        if await whitelist.users.get(user.id) is None:
             try:
-                database.add_user_whitelist(db_sess, user)
+                await async_database.add_user_whitelist(user)
+                await whitelist.users.refresh(user.id)
                 output = 'success'
                 await update.message.reply_text('Успешно активировано!\n'
                                                 'Введите название фильма для поиска')
             except Exception as e:
-                output = e
+                logger.exception('Ошибка активации', extra={'user_id': user.id})
+                output = repr(e)
                 await update.message.reply_text('Произошла ошибка, обратитесь к разработчику')
-            finally:
-                db_sess.close()
         else:
             output = 'repeat'
             await update.message.reply_text('Вы уже имеете доступ к боту.'
@@ -75,29 +130,25 @@ async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     else:
         output = 'Invalid activation code'
         await update.message.reply_text(f'Неверный код активации')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/activate | Вывод: {output}'
-    print(output)
+    logger.info('/activate', extra={'user_id': update.effective_user.id, 'result': output})
 
 
+@instrument('my_sub')
 @check_user
 async def my_sub(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /my_sub
         Передает информацию о его текущей подписке
     """
 
-    user = update.effective_user
-    name, max_request = database.get_sub_user(user)
+    info = await whitelist.users.get(update.effective_user.id)
+    name, max_request = info.name, info.max_request
     await update.message.reply_text(f'Статус подписки: {name}\n'
                                     f'Количество возможных запросов: {max_request}\n'
                                     'Посмотреть количество текущих запросов: /amount')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/my_sub'
-    print(output)
+    logger.info('/my_sub', extra={'user_id': update.effective_user.id})
 
 
+@instrument('amount')
 @check_user
 async def amount_request_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /amount
@@ -105,62 +156,59 @@ async def amount_request_user(update: Update, context: ContextTypes.DEFAULT_TYPE
         а так же максимально доступное количество
     """
 
-    user = update.effective_user
-    amount_request = database.amount_request_user(user)
-    max_request = database.get_max_request(user)
+    info = await whitelist.users.get(update.effective_user.id)
+    amount_request = quota.window.count(info.id, datetime.datetime.now())
+    max_request = info.max_request
     await update.message.reply_text(f'Количество запросов в сутки {amount_request}/{max_request}')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/amount'
-    print(output)
+    logger.info('/amount', extra={'user_id': update.effective_user.id})
 
 
+@instrument('buy')
 @check_user
 async def buy_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /buy
+        После смены подписки необходимо обновить кэш: whitelist.users.refresh(<telegram id>)
     """
 
     await update.message.reply_text(f'Функционал разрабатывается')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/buy'
-    print(output)
+    logger.info('/buy', extra={'user_id': update.effective_user.id})
 
 
+@instrument('random_film')
 @check_user
 async def random_film(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /random_film
-
+        Передает пользователю случайный фильм из заранее подготовленной очереди
     """
-    answer = await api.get_random_film()
-    await update.message.reply_text(answer['data'])
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/random_film'
-    print(output)
+    answer = await prefetch.films.get()
+    if answer is None:
+        await update.message.reply_text('Не удалось найти случайный фильм, попробуйте позже')
+    else:
+        await posters.send_film(context.bot, update.effective_chat.id, answer)
+    logger.info('/random_film', extra={'user_id': update.effective_user.id})
 
 
+@instrument('on_off_mailing')
 @check_user
 async def on_off_mailing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /on_off_mailing
     """
     user = update.effective_user
-    status = database.update_user_mailing(user)
+    status = await async_database.update_user_mailing(user)
+    whitelist.users.set_mailing(user.id, status)
     await update.message.reply_text(f'Статус вашей рассылки: {status}')
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'Изменение рассылки | Текущая: {status}'
-    print(output)
+    logger.info('Изменение рассылки', extra={'user_id': update.effective_user.id, 'mailing': status})
 
 
 
+@instrument('subscriptions')
 @check_user
 async def subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ /subscriptions.
         Передает пользователю информацию о всех доступных подписках
     """
 
-    all_subscriptions = database.view_all_sub()
+    all_subscriptions = await whitelist.users.subscriptions()
     text = (f'На данный момент у нас есть 3 типа подписок:\n'
             f'base: {all_subscriptions["base"]["max_request"]} '
             f'запросов в сутки | стоимость {all_subscriptions["base"]["price"]} рублей\n'
@@ -171,72 +219,130 @@ async def subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             f'Узнать статус своей подписки можно /my_sub\n'
             f'Чтобы купить нужны уровень подписки введите /buy <уровень>')
     await update.message.reply_text(text)
-    date_time = datetime.datetime.now()
-    output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-             f'/subscriptions'
-    print(output)
+    logger.info('/subscriptions', extra={'user_id': update.effective_user.id})
+
+
+def split_title_year(text: str) -> Tuple[str, Optional[str]]:
+    """ Разделение сообщения на название фильма и год выпуска.
+        Год - последнее слово, если это число от 1900 до 2025, иначе все сообщение - название
+    """
+
+    parts = text.split()  # Разделение на слова
+    if len(parts) >= 2:
+        # Если название имеет хотя бы 2 слова (может быть и без года)
+        try:
+            if 1900 <= int(parts[-1]) <= 2025:  # Если это год
+                return ' '.join(parts[:-1]), parts[-1]
+        except ValueError:  # Если это часть названия
+            pass
+    return text, None
+
 
+def parse_imdb_id(text: str) -> Optional[str]:
+    """ imdbID из ссылки IMDb или сообщения, которое состоит только из id (tt0133093). Иначе None """
 
+    text = text.strip()
+    match = IMDB_LINK.search(text)
+    if match is not None:
+        return match.group(1).lower()
+    if IMDB_ID.fullmatch(text):
+        return text.lower()
+    return None
+
+
+@instrument('search_movie')
 @check_user
 async def search_movie(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """ Обрабатывает сообщения с названием фильма """
 
     user = update.effective_user
-    amount_request = database.amount_request_user(user)
-    max_request = database.get_max_request(user)
-    if amount_request >= max_request:
-        await update.message.reply_text('Превышен лимит запросов в сутки.\n'
-                                        'Если хотите больше приобретите статус подписки выше текущей\n'
-                                        '/subscriptions')
-    else:
+    info = await whitelist.users.get(user.id)
+    async with user_lock(user.id):  # Проверка лимита и запись запроса без гонки между сообщениями пользователя
+        date_time = datetime.datetime.now()
+        if not quota.window.allow(info.id, info.max_request, date_time):
+            await update.message.reply_text('Превышен лимит запросов в сутки.\n'
+                                            'Если хотите больше приобретите статус подписки выше текущей\n'
+                                            '/subscriptions')
+            return
+
         text = update.message.text
-        parts = text.split()  # Разделение на слова
-        if len(parts) >= 2:
-            # Если название имеет хотя бы 2 слова (может быть и без года)
-            title = parts[:-1]
-            year = parts[-1]
-            # Проверка последнего слова, что это год
-            try:
-                if 1900 <= int(year) <= 2025:  # Если это год
-                    title = ' '.join(title)
-                    answer = await api.search_movie_data(title, year)
-            except ValueError:  # Если это часть названия
-                title = text
-                answer = await api.search_movie_data(title)
-        # Если название фильма содержит 1 слова без даты
+        imdb_id = parse_imdb_id(text)
+        if imdb_id is not None:  # Ссылка IMDb или id: поиск по imdbID без поиска по названию
+            title = imdb_id
+            answer = await api.search_movie_by_id(imdb_id)
         else:
-            title = text
-            answer = await api.search_movie_data(title)
+            title, year = split_title_year(text)
+            if year is not None:
+                answer = await api.search_movie_data(title, year)
+            else:
+                answer = await api.search_movie_data(title)
+
+        date_time = datetime.datetime.now()
         if answer["error"] is None:
-            await update.message.reply_text(answer['data'])
-            # Запись в request
-            date_time = datetime.datetime.now()
-            database.add_request(user=update.effective_user,
-                                 imdb_id=answer['imdbID'],
-                                 date_time=date_time)
-            database.update_last_request(user=update.effective_user, date_time=date_time)
+            quota.window.add(info.id, date_time, info.max_request)
+            suggest.titles.touch(answer['imdbID'])
+            await posters.send_film(context.bot, update.effective_chat.id, answer)
         else:
             await update.message.reply_text(answer['error'])
-            # Запись в bad_request
-            date_time = datetime.datetime.now()
-            database.add_bad_request(user=update.effective_user,
-                                     title=text,
-                                     date_time=date_time,
-                                     error=answer['error'])
-            database.update_last_request(user=update.effective_user, date_time=date_time)
 
-        output = f'[{date_time.strftime("%Y-%m-%d %H:%M:%S")}] | {update.effective_user.id} | ' \
-                 f'{title} | {answer["response"]} | {answer["error"]}'
-        print(output)
+    # Запись в request или bad_request после ответа и без блокировки пользователя:
+    # если очередь записи заполнена, ждет только эта обработка
+    if answer["error"] is None:
+        await request_log.log.add_request(user_id=info.id,
+                                          imdb_id=answer['imdbID'],
+                                          date_time=date_time)
+    else:
+        await request_log.log.add_bad_request(user_id=info.id,
+                                              title=text,
+                                              date_time=date_time,
+                                              error=answer['error'])
+
+    logger.info('Поиск фильма', extra={'user_id': update.effective_user.id, 'title': title,
+                                       'response': answer['response'], 'error': answer['error']})
+
 
+@instrument('inline_query')
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ Подсказки названий при вводе @бот <название>. Выбранная подсказка отправляется боту как поиск фильма """
 
+    if await whitelist.users.get(update.effective_user.id) is None:
+        await update.inline_query.answer([], cache_time=0, is_personal=True)
+        return
+
+    results = [InlineQueryResultArticle(id=film.imdb_id,
+                                        title=film.title,
+                                        description=film.year,
+                                        input_message_content=InputTextMessageContent(film.label))
+               for film in suggest.titles.search(update.inline_query.query)]
+    await update.inline_query.answer(results, cache_time=suggest.CACHE_TIME, is_personal=True)
+
+
+@instrument('mailing')
 async def mailing_for_user(context: CallbackContext):
-    """ Отправляет пользователям, у которых включена рассылка случайный фильм """
+    """ Отправляет пользователям, у которых включена рассылка случайный фильм.
+        Если предыдущая рассылка была прервана, сначала она продолжается
+    """
+
+    await resume_mailing(context)
+    film = await prefetch.films.get()
+    if film is None:
+        logger.warning('Рассылка пропущена, не удалось найти случайный фильм')
+        return
+    run_id = await async_database.create_mailing_run(film['imdbID'], film['data'])
+    counts = await mailing.send_mailing(context.bot, run_id, film['data'], film)
+    logger.info('Рассылка завершена', extra={'run_id': run_id, 'imdb_id': film['imdbID'], **counts})
 
-    users_id = database.users_id_with_mailing()
-    film = await api.get_random_film()
-    for telegram_id in users_id:
-        await context.bot.send_message(telegram_id, film['data'])
+
+@instrument('resume_mailing')
+async def resume_mailing(context: CallbackContext):
+    """ Продолжает прерванную рассылку """
+
+    run = await async_database.get_unfinished_mailing_run()
+    if run is None:
+        return
+    film = await cache.movies.get_by_imdb_id(run.imdbID)
+    counts = await mailing.send_mailing(context.bot, run.id, run.text, api.make_answer(film) if film else None)
+    logger.info('Прерванная рассылка завершена', extra={'run_id': run.id, 'imdb_id': run.imdbID, **counts})
 
 
 def setup_scheduler(application):
@@ -261,10 +367,100 @@ def setup_scheduler(application):
         )
 
 
-def main() -> None:
-    """ Запуск бота """
-
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+async def report_stats(context: CallbackContext) -> None:
+    """ Вывод статистики кэшей, запросов к OMDb и пула соединений с базой данных """
+
+    logger.info('Кэш | Белый лист: %s | Фильмы: %s', whitelist.users.stats(), cache.movies.stats())
+    logger.info('OMDb | Запросы: %s | Объединено: %s | Ключи: %s', api.upstream_calls.value, api.coalesced_calls.value,
+                omdb_keys.pool.stats())
+    wait = database.db_checkout_wait
+    query = database.db_query_duration
+    logger.info('База данных | Пул: %s | Ожидание соединения: %s раз, %.3f с | Запросы: %s шт, %.3f с',
+                database.pool_status(), wait.count, wait.sum, query.count, query.sum)
+
+
+def collect_cache_stats() -> None:
+    """ Перенос статистики кэшей в метрики перед выгрузкой """
+
+    movies = cache.movies.stats()
+    sources = {
+        'whitelist': whitelist.users.stats(),
+        'titles': movies['titles'],
+        'films': movies['films'],
+        'movie_cache_db': {'hits': movies['db_hits'], 'misses': movies['db_misses'], 'errors': movies['db_errors'],
+                           'pending': movies['db_pending']},
+        'random_films': {'size': prefetch.films.qsize()},
+        'suggest': suggest.titles.stats(),
+        'posters': posters.store.stats(),
+    }
+    for name, stats in sources.items():
+        for stat, value in stats.items():
+            cache_stats.labels(cache=name, stat=stat).set(value)
+
+
+async def error_handler(update: object, context: CallbackContext) -> None:
+    """ Запись в журнал необработанных ошибок обработчиков и задач """
+
+    user_id = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+    logger.error('Необработанная ошибка', exc_info=context.error, extra={'user_id': user_id})
+
+
+async def reconcile_quota(context: CallbackContext) -> None:
+    """ Сверка счетчиков запросов с таблицей request """
+
+    await quota.window.load()
+
+
+async def on_startup(application) -> None:
+    """ Действия при запуске бота """
+
+    while not await async_database.run(database.acquire_instance_lock):  # Например, старый процесс при обновлении
+        logger.warning('С этой базой уже работает другой процесс бота, ожидание его остановки')
+        await asyncio.sleep(INSTANCE_WAIT)
+    await async_database.run(database.create_tables)  # Новые таблицы и индексы, существующие не изменяются
+    await api.start_session()
+    await mparser.start_session()
+    await whitelist.users.warm()
+    prefetch.films.start()
+    request_log.log.start()
+    await quota.window.load()
+    await omdb_keys.pool.load()
+    await suggest.titles.load()
+    await metrics.start_server()
+
+
+async def on_shutdown(application) -> None:
+    """ Действия при остановке бота. Ошибка одного шага не отменяет остальные """
+
+    steps = (
+        metrics.stop_server,
+        prefetch.films.stop,
+        request_log.log.stop,
+        cache.movies.drain,
+        omdb_keys.pool.flush,
+        api.close_session,
+        mparser.close_session,
+        functools.partial(async_database.run, database.release_instance_lock),
+    )
+    for step in steps:
+        try:
+            await step()
+        except Exception:
+            logger.exception('Ошибка при остановке бота', extra={'step': getattr(step, '__qualname__', repr(step))})
+    async_database.shutdown()
+
+
+def build_application() -> Application:
+    """ Создание бота со всеми обработчиками и задачами планировщика """
+
+    application = (ApplicationBuilder()
+                   .token(TELEGRAM_BOT_TOKEN)
+                   .base_url(BASE_URL)
+                   .request(InstrumentedRequest(connection_pool_size=256))
+                   .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+                   .post_init(on_startup)
+                   .post_shutdown(on_shutdown)
+                   .build())
 
     start_handler = CommandHandler('start', start)
     activate_handler = CommandHandler('activate', activate)
@@ -275,6 +471,7 @@ def main() -> None:
     amount_request_user_handler = CommandHandler('amount', amount_request_user)
     random_film_handler = CommandHandler('random_film', random_film)
     search_movie_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, search_movie)
+    inline_query_handler = InlineQueryHandler(inline_query)
 
     application.add_handler(start_handler)
     application.add_handler(activate_handler)
@@ -285,9 +482,32 @@ def main() -> None:
     application.add_handler(random_film_handler)
     application.add_handler(amount_request_user_handler)
     application.add_handler(search_movie_handler)
+    application.add_handler(inline_query_handler)
+    application.add_error_handler(error_handler)
+    metrics.on_collect(collect_cache_stats)
+    metrics.on_collect(omdb_keys.collect_metrics)
 
     setup_scheduler(application)  # Запуск планировщика
-    application.run_polling()
+    application.job_queue.run_once(resume_mailing, when=10)
+    application.job_queue.run_repeating(rollup.rollup_job, interval=rollup.INTERVAL, first=60)
+    application.job_queue.run_repeating(cache.cleanup_job, interval=cache.CLEANUP_INTERVAL, first=120)
+    application.job_queue.run_repeating(reconcile_quota, interval=quota.RECONCILE_INTERVAL,
+                                        first=quota.RECONCILE_INTERVAL)
+    application.job_queue.run_repeating(omdb_keys.flush_job, interval=omdb_keys.FLUSH_INTERVAL,
+                                        first=omdb_keys.FLUSH_INTERVAL)
+    application.job_queue.run_repeating(report_stats, interval=3600, first=3600)
+    return application
+
+
+def main() -> None:
+    """ Запуск бота """
+
+    logs.setup()
+    application = build_application()
+    if MODE == 'webhook':
+        webhook.run(application)
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+""" Кэширование ответов OMDb """
+
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from typing import Any, Hashable, Optional, Tuple, Union
+
+import async_database
+from movie import Movie
+
+config = ConfigParser()
+config.read('config.ini')
+CACHE_SIZE = config.getint('cache', 'size', fallback=1000)
+CACHE_TTL = config.getint('cache', 'ttl', fallback=7 * 24 * 3600)
+NEGATIVE_TTL = config.getint('cache', 'negative_ttl', fallback=3600)
+CLEANUP_INTERVAL = config.getint('cache', 'cleanup_interval', fallback=3600)  # Секунд между очистками базы
+
+NOT_FOUND = ''  # imdbID для фильмов, которые OMDb не нашел
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """ Кэш в памяти процесса с ограничением размера и временем жизни записей.
+        При переполнении удаляется запись, к которой дольше всего не обращались
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Значение по ключу, устаревшие записи удаляются """
+
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expired += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """ Добавление записи, при переполнении удаляются самые старые """
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        """ Удаление записи """
+
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """ Счетчики попаданий, промахов и вытеснений """
+
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+        }
+
+
+def movie_key(title: str, year: Union[str, None] = None) -> str:
+    """ Нормализованный ключ кэша по названию и году """
+
+    title = re.sub(r'\s+', ' ', title).strip().casefold()
+    year = year.strip() if year and year.strip().isdigit() else ''
+    return f'{title}|{year}'
+
+
+class MovieCache:
+    """ Двухуровневый кэш ответов OMDb.
+        Первый уровень - LRU в памяти процесса, второй - таблицы movie_cache и film в Postgresql.
+        Названия хранятся отдельно от фильмов, поэтому несколько вариантов написания
+        ссылаются на одну запись по imdbID.
+        Второй уровень необязателен: ошибка базы считается промахом, а запись в базу идет в фоне, не задерживая ответ
+    """
+
+    def __init__(self, size: int = CACHE_SIZE, ttl: int = CACHE_TTL, negative_ttl: int = NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.titles = LRUCache(size, ttl)  # ключ -> imdbID или NOT_FOUND
+        self.films = LRUCache(size, ttl)  # imdbID -> Movie
+        self.db_hits = 0
+        self.db_misses = 0
+        self.db_errors = 0
+        self._writes = set()  # Фоновые записи в базу
+
+    async def get(self, key: str) -> Tuple[bool, Optional[Movie]]:
+        """ Поиск по ключу.
+            Возвращает (найдено ли в кэше, фильм или None, если фильм не найден)
+        """
+
+        found, film = self.peek(key)
+        if found:
+            return True, film
+        return await self.load(key)
+
+    def peek(self, key: str) -> Tuple[bool, Optional[Movie]]:
+        """ Поиск по ключу только в памяти процесса, без запроса к базе """
+
+        imdb_id = self.titles.get(key)
+        if imdb_id == NOT_FOUND:
+            return True, None
+        if imdb_id is not None:
+            film = self.films.get(imdb_id)
+            if film is not None:
+                return True, film
+        return False, None
+
+    async def load(self, key: str) -> Tuple[bool, Optional[Movie]]:
+        """ Поиск по ключу в базе, найденное запоминается в памяти процесса """
+
+        try:
+            row = await async_database.get_movie_cache(key)
+        except Exception:
+            self._failed('Ошибка чтения кэша из базы данных', key)
+            return False, None
+        if row is None:
+            self.db_misses += 1
+            return False, None
+        self.db_hits += 1
+        ttl = (row.expires_at - datetime.now()).total_seconds()
+        film = self.films.get(row.imdbID) if row.imdbID else None  # Уже разобранный фильм с готовым текстом
+        if film is None and row.data is not None:
+            film = Movie.from_omdb(row.data)
+        self._remember(key, row.imdbID, film, ttl)
+        return True, film
+
+    async def get_by_imdb_id(self, imdb_id: str) -> Optional[Movie]:
+        """ Поиск фильма по imdbID """
+
+        film = self.films.get(imdb_id)
+        if film is not None:
+            return film
+
+        try:
+            row = await async_database.get_film(imdb_id)
+        except Exception:
+            self._failed('Ошибка чтения фильма из базы данных', imdb_id)
+            return None
+        if row is None:
+            self.db_misses += 1
+            return None
+        self.db_hits += 1
+        ttl = (row.expires_at - datetime.now()).total_seconds()
+        film = Movie.from_omdb(row.data)
+        self.films.set(imdb_id, film, ttl)
+        return film
+
+    async def set(self, key: str, film: Optional[Movie]) -> None:
+        """ Сохранение фильма. film = None - фильм не найден.
+            В базу записываются только поля Movie, а не весь ответ OMDb
+        """
+
+        imdb_id = film.imdb_id if film is not None else NOT_FOUND
+        ttl = self.ttl if film is not None else self.negative_ttl
+        self._remember(key, imdb_id, film, ttl)
+        expires_at = datetime.now() + timedelta(seconds=ttl)
+        data = film.to_omdb() if film is not None else None
+        task = asyncio.create_task(self._write(key, imdb_id or None, data, expires_at))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, key: str, imdb_id: Optional[str], data: Optional[dict], expires_at: datetime) -> None:
+        """ Запись в кэш второго уровня """
+
+        try:
+            await async_database.set_movie_cache(key, imdb_id, data, expires_at)
+        except Exception:
+            self._failed('Ошибка записи кэша в базу данных', key)
+
+    async def drain(self) -> None:
+        """ Ожидание незавершенных записей в базу, перед остановкой """
+
+        if self._writes:
+            await asyncio.gather(*self._writes)
+
+    def _failed(self, message: str, key: str) -> None:
+        self.db_errors += 1
+        logger.warning(message, exc_info=True, extra={'key': key})
+
+    def _remember(self, key: str, imdb_id: Optional[str], film: Optional[Movie], ttl: float) -> None:
+        """ Запись в кэш первого уровня """
+
+        if not imdb_id or film is None:
+            self.titles.set(key, NOT_FOUND, min(ttl, self.negative_ttl))
+            return
+        self.titles.set(key, imdb_id, ttl)
+        self.films.set(imdb_id, film, ttl)
+
+    def stats(self) -> dict:
+        """ Счетчики кэша """
+
+        return {
+            'titles': self.titles.stats(),
+            'films': self.films.stats(),
+            'db_hits': self.db_hits,
+            'db_misses': self.db_misses,
+            'db_errors': self.db_errors,
+            'db_pending': len(self._writes),
+        }
+
+
+async def cleanup_job(context) -> None:
+    """ Задача планировщика: удаление устаревших записей movie_cache и film """
+
+    logger.info('Удалено устаревших записей кэша: %s', await async_database.delete_expired_movie_cache())
+
+
+movies = MovieCache()
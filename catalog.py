@@ -0,0 +1,149 @@
+""" Локальный каталог фильмов из выгрузок IMDb (https://datasets.imdbws.com).
+    По каталогу название и год сопоставляются с imdbID без запроса к OMDb,
+    из OMDb затем загружаются только данные фильма по imdbID.
+    Загрузка из консоли, файлы читаются построчно, в памяти только одна пачка строк:
+        python catalog.py basics title.basics.tsv.gz - фильмы, основные и оригинальные названия
+        python catalog.py akas title.akas.tsv.gz [RU,SUHH] - локализованные названия, после basics
+        python catalog.py ratings title.ratings.tsv.gz - количество голосов для выбора среди одинаковых названий
+"""
+
+import gzip
+import logging
+import re
+import sys
+import unicodedata
+from configparser import ConfigParser
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Union
+
+import async_database
+import database
+import logs
+
+config = ConfigParser()
+config.read('config.ini')
+ENABLED = config.getboolean('catalog', 'enabled', fallback=False)  # Включать после загрузки каталога
+KINDS = set(config.get('catalog', 'kinds', fallback='movie,tvMovie').split(','))
+REGIONS = config.get('catalog', 'regions', fallback='RU')
+BATCH_SIZE = config.getint('catalog', 'batch_size', fallback=2000)  # Postgres принимает до 32767 параметров в запросе
+
+NULL = '\\N'  # Пустое значение в выгрузках IMDb
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_title(title: str) -> str:
+    """ Название для поиска: без регистра, знаков препинания и лишних пробелов, ё заменена на е """
+
+    title = unicodedata.normalize('NFKC', title).casefold().replace('ё', 'е')
+    return ' '.join(re.sub(r'[^\w]+|_', ' ', title).split())
+
+
+def parse_year(year: Union[str, int, None]) -> Optional[int]:
+    year = str(year).strip() if year is not None else ''
+    return int(year) if year.isdigit() else None
+
+
+async def find(title: str, year: Union[str, None] = None) -> Optional[str]:
+    """ imdbID фильма по названию и году.
+        None, если каталог выключен, фильма нет или несколько фильмов с таким названием нельзя различить по популярности
+    """
+
+    if not ENABLED:
+        return None
+    normalized = normalize_title(title)
+    if not normalized:
+        return None
+    rows = await async_database.find_catalog_title(normalized, parse_year(year))
+    if not rows:
+        return None
+    if len(rows) == 1:
+        return rows[0][0]
+    (imdb_id, votes), (_, other_votes) = rows[:2]
+    if votes is not None and (other_votes is None or votes > other_votes):
+        return imdb_id
+    return None
+
+
+def read_tsv(path: str) -> Iterator[dict]:
+    """ Построчное чтение выгрузки IMDb. Кавычки в выгрузках не экранируются, поэтому csv не используется """
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='\n') as file:
+        header = file.readline().rstrip('\n').split('\t')
+        for line in file:
+            yield dict(zip(header, line.rstrip('\n').split('\t')))
+
+
+def batched(rows: Iterable, size: int) -> Iterator[List]:
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def import_basics(path: str, kinds: set = KINDS, batch_size: int = BATCH_SIZE) -> int:
+    """ Загрузка фильмов из title.basics. Возвращает количество загруженных фильмов """
+
+    rows = (row for row in read_tsv(path) if row['titleType'] in kinds)
+    total = 0
+    for batch in batched(rows, batch_size):
+        titles, names = [], []
+        for row in batch:
+            year = parse_year(row['startYear'])
+            titles.append({'imdbID': row['tconst'], 'title': row['primaryTitle'][:500],
+                           'year': year, 'kind': row['titleType']})
+            for title in {normalize_title(row['primaryTitle']), normalize_title(row['originalTitle'])}:
+                if title:
+                    names.append({'imdbID': row['tconst'], 'normalized_title': title[:500], 'year': year})
+        database.import_catalog_titles(titles, names)
+        total += len(titles)
+        logger.info('Загружено фильмов: %s', total)
+    return total
+
+
+def import_akas(path: str, regions: str = REGIONS, batch_size: int = BATCH_SIZE) -> int:
+    """ Загрузка локализованных названий из title.akas для фильмов, уже загруженных из title.basics """
+
+    regions = set(regions.split(','))
+    rows = (row for row in read_tsv(path) if row['region'] in regions)
+    total = 0
+    for batch in batched(rows, batch_size):
+        names = {(row['titleId'], normalize_title(row['title'])[:500]) for row in batch}
+        total += database.import_catalog_names([name for name in names if name[1]])
+        logger.info('Загружено названий: %s', total)
+    return total
+
+
+def import_ratings(path: str, batch_size: int = BATCH_SIZE) -> int:
+    """ Загрузка количества голосов из title.ratings """
+
+    total = 0
+    for batch in batched(read_tsv(path), batch_size):
+        database.import_catalog_ratings([{'imdbID': row['tconst'], 'votes': int(row['numVotes'])}
+                                         for row in batch if row['numVotes'] != NULL])
+        total += len(batch)
+        logger.info('Загружено рейтингов: %s', total)
+    return total
+
+
+def main() -> None:
+    logs.setup()
+    if len(sys.argv) < 3:
+        print(__doc__)
+        return
+    command, path = sys.argv[1], sys.argv[2]
+    database.create_tables()
+    if command == 'basics':
+        import_basics(path)
+    elif command == 'akas':
+        import_akas(path, sys.argv[3] if len(sys.argv) > 3 else REGIONS)
+    elif command == 'ratings':
+        import_ratings(path)
+    else:
+        print(__doc__)
+        return
+    logger.info('Фильмов в каталоге: %s', database.catalog_size())
+
+
+if __name__ == '__main__':
+    main()
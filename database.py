@@ -1,11 +1,22 @@
 """ Логика работы с базой данных Postgresql """
 
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, DateTime, ForeignKey, Boolean
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import (create_engine, Column, Integer, String, BigInteger, Date, DateTime, ForeignKey, Boolean, JSON,
+                        Index, Text, cast, column, delete, event, func, insert, literal, select, text, update, values)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
-from datetime import datetime, timedelta
+from sqlalchemy.pool import QueuePool
+from datetime import date, datetime, timedelta
 from configparser import ConfigParser
 from telegram import _user
 
+import metrics
+
+logger = logging.getLogger(__name__)
+
 config = ConfigParser()
 config.read('config.ini')
 db_host = config['postgresql']['host']
@@ -13,12 +24,127 @@ db_name = config['postgresql']['name']
 db_user = config['postgresql']['user']
 db_password = config['postgresql']['password']
 
+# Настройки пула соединений
+POOL_SIZE = config.getint('postgresql', 'pool_size', fallback=5)
+MAX_OVERFLOW = config.getint('postgresql', 'max_overflow', fallback=10)
+POOL_TIMEOUT = config.getfloat('postgresql', 'pool_timeout', fallback=30)
+POOL_RECYCLE = config.getint('postgresql', 'pool_recycle', fallback=1800)
+POOL_PRE_PING = config.getboolean('postgresql', 'pool_pre_ping', fallback=True)
+STATEMENT_TIMEOUT = config.getint('postgresql', 'statement_timeout', fallback=5000)  # мс, 0 - без ограничения
+
+db_checkout_wait = metrics.histogram('db_pool_checkout_wait_seconds', 'Ожидание свободного соединения из пула')
+db_connections_in_use = metrics.gauge('db_pool_connections_in_use', 'Выданные из пула соединения')
+db_connections_idle = metrics.gauge('db_pool_connections_idle', 'Свободные соединения в пуле')
+db_query_duration = metrics.histogram('db_query_duration_seconds', 'Длительность запросов к базе данных')
+db_queries = metrics.counter('db_queries_total', 'Количество запросов к базе данных')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ Пул соединений с замером времени ожидания свободного соединения """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_checkout_wait.observe(time.perf_counter() - start)
+
+
 # Создание базы данных
 DATABASE_URL = f'postgresql+pg8000://{db_user}:{db_password}@{db_host}/{db_name}'
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL,
+                       poolclass=InstrumentedQueuePool,
+                       pool_size=POOL_SIZE,
+                       max_overflow=MAX_OVERFLOW,
+                       pool_timeout=POOL_TIMEOUT,
+                       pool_recycle=POOL_RECYCLE,
+                       pool_pre_ping=POOL_PRE_PING)
+SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
 
+@event.listens_for(engine, 'connect')
+def set_statement_timeout(dbapi_connection, connection_record) -> None:
+    """ Ограничение времени выполнения запросов для каждого нового соединения """
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'SET statement_timeout = {STATEMENT_TIMEOUT}')
+    cursor.close()
+    dbapi_connection.commit()
+
+
+@event.listens_for(engine, 'checkout')
+@event.listens_for(engine, 'checkin')
+def update_pool_status(*args) -> None:
+    """ Обновление количества занятых и свободных соединений """
+
+    db_connections_in_use.set(engine.pool.checkedout())
+    db_connections_idle.set(engine.pool.checkedin())
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    # Одно значение на соединение: запросы в нем не вложены, а после ошибки
+    # after_cursor_execute не вызывается, и значение перезаписывается следующим запросом
+    conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    db_query_duration.observe(time.perf_counter() - conn.info.pop('query_start'))
+    db_queries.inc()
+
+
+@event.listens_for(engine, 'handle_error')
+def handle_error(context) -> None:
+    """ Запрос завершился ошибкой: время начала больше не нужно """
+
+    if context.connection is not None:
+        context.connection.info.pop('query_start', None)
+
+
+INSTANCE_LOCK = 0x6d6f7669  # Ключ advisory lock единственного процесса бота
+_instance_connection = None
+
+
+def acquire_instance_lock() -> bool:
+    """ Блокировка процесса бота (advisory lock Postgresql), False - ее держит другой процесс.
+        Лимиты запросов, порядок сообщений и задачи планировщика работают в памяти процесса,
+        поэтому с одной базой должен работать один процесс. Блокировка держится отдельным соединением
+    """
+
+    global _instance_connection
+    connection = engine.connect()
+    locked = connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': INSTANCE_LOCK}).scalar()
+    connection.commit()  # Блокировка уровня сессии остается после завершения транзакции
+    if not locked:
+        connection.close()
+        return False
+    _instance_connection = connection
+    return True
+
+
+def release_instance_lock() -> None:
+    """ Снятие блокировки процесса: соединение закрывается, а не возвращается в пул вместе с блокировкой """
+
+    global _instance_connection
+    if _instance_connection is not None:
+        _instance_connection.invalidate()
+        _instance_connection.close()
+        _instance_connection = None
+
+
+def pool_status() -> dict:
+    """ Текущее состояние пула соединений """
+
+    return {
+        'size': engine.pool.size(),
+        'in_use': engine.pool.checkedout(),
+        'idle': engine.pool.checkedin(),
+        'overflow': engine.pool.overflow(),
+    }
+
+
 class User(Base):
     """ Таблица user.
         Хранит информацию об авторизированных пользователях:
@@ -31,12 +157,16 @@ class User(Base):
 
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
-    user_telegram_id = Column(BigInteger, nullable=False)
+    user_telegram_id = Column(BigInteger, nullable=False, unique=True, index=True)
     last_request = Column(DateTime, nullable=True)
     username = Column(String(255), nullable=True)
     subscription = Column(Integer, ForeignKey('subscription.id'))
     mailing = Column(Boolean, default=False)
 
+    __table_args__ = (
+        Index('ix_user_mailing_id', 'id', postgresql_where=text('mailing')),  # Постраничный обход рассылки
+    )
+
 
 # class Transaction(Base):
 #     """ Таблица transaction.
@@ -70,10 +200,13 @@ class Request(Base):
     """
 
     __tablename__ = 'request'
+    __table_args__ = (
+        Index('ix_request_user_id_date_time', 'user_id', 'date_time'),  # Подсчет запросов пользователя за сутки
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     imdbID = Column(String(50), nullable=False)
-    date_time = Column(DateTime, default=datetime.utcnow)
+    date_time = Column(DateTime, default=datetime.utcnow, index=True)
 
 
 class BadRequest(Base):
@@ -89,18 +222,202 @@ class BadRequest(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     title = Column(String(50), nullable=False)
-    date_time = Column(DateTime, default=datetime.utcnow)
+    date_time = Column(DateTime, default=datetime.utcnow, index=True)
     error = Column(String(200), nullable=False)
 
 
+class MovieCache(Base):
+    """ Таблица movie_cache.
+        Хранит ответы OMDb между перезапусками бота:
+            - Нормализованные название и год
+            - imdbID найденного фильма (пусто, если фильм не найден)
+            - Ответ OMDb
+            - Время, до которого запись актуальна
+    """
+
+    __tablename__ = 'movie_cache'
+    key = Column(String(300), primary_key=True)
+    imdbID = Column(String(50), nullable=True, index=True)
+    data = Column(JSON, nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class Film(Base):
+    """ Таблица film.
+        Найденные фильмы по imdbID: поля Movie в формате ответа OMDb и время, до которого запись актуальна.
+        movie_cache ссылается на фильм по imdbID, поэтому несколько названий одного фильма хранят его один раз
+    """
+
+    __tablename__ = 'film'
+    imdbID = Column(String(50), primary_key=True)
+    data = Column(JSON, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class PosterFile(Base):
+    """ Таблица poster_file.
+        file_id фотографии постера, уже загруженной в Telegram, по imdbID фильма.
+        Повторная отправка постера по file_id не загружает изображение заново
+    """
+
+    __tablename__ = 'poster_file'
+    imdbID = Column(String(50), primary_key=True)
+    file_id = Column(String(200), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class OmdbKeyUsage(Base):
+    """ Таблица omdb_key_usage.
+        Запросы каждого ключа OMDb за сутки (UTC), чтобы после перезапуска не превысить лимит.
+        Ключ хранится как первые 16 символов sha256
+    """
+
+    __tablename__ = 'omdb_key_usage'
+    key_id = Column(String(16), primary_key=True)
+    day = Column(Date, primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    exhausted = Column(Boolean, nullable=False, default=False)
+
+
+class MailingRun(Base):
+    """ Таблица mailing_run.
+        Хранит информацию о рассылках:
+            - imdbID и текст отправляемого фильма
+            - Время начала и окончания рассылки
+    """
+
+    __tablename__ = 'mailing_run'
+    id = Column(Integer, primary_key=True)
+    imdbID = Column(String(50), nullable=False)
+    text = Column(Text, nullable=False)
+    started_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class MailingDelivery(Base):
+    """ Таблица mailing_delivery.
+        Результат отправки рассылки каждому пользователю:
+            - id рассылки из таблицы mailing_run
+            - Телеграм id получателя
+            - Статус: sent, blocked, failed
+            - Ошибка
+            - Время отправки
+    """
+
+    __tablename__ = 'mailing_delivery'
+    run_id = Column(Integer, ForeignKey('mailing_run.id'), primary_key=True)
+    telegram_id = Column(BigInteger, primary_key=True)
+    status = Column(String(20), nullable=False)
+    error = Column(String(200), nullable=True)
+    date_time = Column(DateTime, default=datetime.now)
+
+
+class RequestDaily(Base):
+    """ Таблица request_daily.
+        Количество запросов пользователя за день:
+            - День
+            - user id из таблицы user
+            - Количество успешных и неуспешных запросов
+    """
+
+    __tablename__ = 'request_daily'
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    bad_requests = Column(Integer, nullable=False, default=0)
+
+
+class FilmDaily(Base):
+    """ Таблица film_daily.
+        Количество успешных запросов фильма за день
+    """
+
+    __tablename__ = 'film_daily'
+    day = Column(Date, primary_key=True)
+    imdbID = Column(String(50), primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+
+
+class DailyTotal(Base):
+    """ Таблица daily_total.
+        Общее количество успешных и неуспешных запросов за день
+    """
+
+    __tablename__ = 'daily_total'
+    day = Column(Date, primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    bad_requests = Column(Integer, nullable=False, default=0)
+
+
+class RollupState(Base):
+    """ Таблица rollup_state.
+        id последней записи request и bad_request, учтенной в дневной статистике.
+        Записи request_retention и bad_request_retention появляются после удаления старых записей:
+        статистику за удаленные дни уже нельзя пересчитать
+    """
+
+    __tablename__ = 'rollup_state'
+    name = Column(String(50), primary_key=True)
+    last_id = Column(BigInteger, nullable=False, default=0)
+
+
+class CatalogTitle(Base):
+    """ Таблица catalog_title.
+        Локальный каталог фильмов из выгрузки IMDb (title.basics):
+            - imdbID
+            - Основное название
+            - Год выпуска
+            - Тип: movie, tvMovie и т.д.
+    """
+
+    __tablename__ = 'catalog_title'
+    imdbID = Column(String(12), primary_key=True)
+    title = Column(String(500), nullable=False)
+    year = Column(Integer, nullable=True)
+    kind = Column(String(20), nullable=False)
+
+
+class CatalogName(Base):
+    """ Таблица catalog_name.
+        Нормализованные названия фильма для поиска: основное, оригинальное и локализованные (title.akas).
+        Год повторяется из catalog_title, чтобы поиск по названию и году шел по одному индексу
+    """
+
+    __tablename__ = 'catalog_name'
+    imdbID = Column(String(12), ForeignKey('catalog_title.imdbID'), primary_key=True)
+    normalized_title = Column(String(500), primary_key=True)
+    year = Column(Integer, nullable=True)
+    __table_args__ = (Index('ix_catalog_name_title_year', 'normalized_title', 'year'),)
+
+
+class CatalogRating(Base):
+    """ Таблица catalog_rating.
+        Количество голосов IMDb (title.ratings), из одинаковых названий выбирается самый популярный фильм
+    """
+
+    __tablename__ = 'catalog_rating'
+    imdbID = Column(String(12), primary_key=True)
+    votes = Column(Integer, nullable=False)
+
+
 def create_tables() -> None:
     """ Создание таблиц в базе данных """
 
     try:
         Base.metadata.create_all(engine)
-        print('Таблицы успешно созданы')
+        logger.info('Таблицы успешно созданы')
+        create_indexes()
     except Exception as e:
-        print(f'Произошла ошибка при создании таблиц: {e}')
+        logger.exception('Произошла ошибка при создании таблиц: %s', e)
+
+
+def create_indexes() -> None:
+    """ Создание индексов, которых нет в уже существующих таблицах """
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 def add_user_whitelist(db: Session, user: _user,  last_request: datetime = None) -> User:  # user тип
@@ -141,19 +458,44 @@ def add_request(user: _user, imdb_id: str, date_time: datetime) -> Request:
             return request
 
 
-def add_bad_request(user: _user, title, date_time: datetime, error: str) -> BadRequest:
-    """ Добавление записи в bad_request """
+def add_bad_request(user: _user, title, date_time: datetime, error: str) -> None:
+    """ Добавление записи в bad_request и обновление поля last_request у user одной транзакцией """
 
-    with session_local() as db_sess:
-        user_in_table = db_sess.query(User).filter(User.user_telegram_id == user.id).first()
-        request = BadRequest(user_id=user_in_table.id,
-                             title=title,
-                             date_time=date_time,
-                             error=error)
-        db_sess.add(request)
-        db_sess.commit()
-        db_sess.refresh(request)
-        return request
+    with session_local() as db_sess, db_sess.begin():
+        user_id = select(User.id).where(User.user_telegram_id == user.id).scalar_subquery()
+        db_sess.execute(insert(BadRequest).values(user_id=user_id,
+                                                  title=title,
+                                                  date_time=date_time,
+                                                  error=error))
+        (db_sess.query(User)
+         .filter(User.user_telegram_id == user.id)
+         .update({User.last_request: date_time}, synchronize_session=False))
+
+
+def requests_since(since: datetime) -> list:
+    """ Успешные запросы начиная с since: список (id пользователя, дата и время) по возрастанию времени """
+
+    with session_local() as sess:
+        rows = (sess.query(Request.user_id, Request.date_time)
+                .filter(Request.date_time >= since)
+                .order_by(Request.date_time))
+        return [tuple(row) for row in rows]
+
+
+def write_request_log(requests: list, bad_requests: list, last_requests: dict) -> None:
+    """ Запись накопленных запросов одной транзакцией.
+        requests - список словарей для request, bad_requests - для bad_request,
+        last_requests - время последнего запроса по id пользователя
+    """
+
+    with session_local() as sess, sess.begin():
+        if requests:
+            sess.execute(insert(Request).values(requests))
+        if bad_requests:
+            sess.execute(insert(BadRequest).values(bad_requests))
+        if last_requests:
+            sess.execute(update(User), [{'id': user_id, 'last_request': date_time}
+                                        for user_id, date_time in last_requests.items()])
 
 
 def update_last_request(user: _user, date_time: datetime) -> None:
@@ -178,8 +520,7 @@ def update_user_mailing(user: _user) -> bool:
 def session_local() -> Session:
     """ Создание сессии в SQLAlchemy """
 
-    session = sessionmaker(bind=engine)
-    return session()
+    return SessionLocal()
 
 
 def view_all_sub() -> dict:
@@ -218,6 +559,27 @@ def get_sub_user(user: _user) -> tuple:
         return subscription.name, subscription.max_request
 
 
+def _user_info_query(sess: Session):
+    return (sess.query(User.user_telegram_id, User.id, Subscription.id, Subscription.name,
+                       Subscription.max_request, User.mailing)
+            .join(Subscription, User.subscription == Subscription.id))
+
+
+def get_user_info(telegram_id: int) -> Optional[tuple]:
+    """ id пользователя, id, название и максимальное количество запросов подписки, статус рассылки """
+
+    with session_local() as sess:
+        row = _user_info_query(sess).filter(User.user_telegram_id == telegram_id).first()
+        return tuple(row[1:]) if row is not None else None
+
+
+def get_all_users_info() -> list:
+    """ Информация о всех пользователях белого листа: telegram id и данные как в get_user_info """
+
+    with session_local() as sess:
+        return [tuple(row) for row in _user_info_query(sess).all()]
+
+
 def amount_request_user(user: _user) -> int:
     """ Информация о количестве запросов пользователя за эти сутки """
 
@@ -231,13 +593,16 @@ def amount_request_user(user: _user) -> int:
 
 
 def amount_request_for_day() -> int:
-    """ Количество выполненных запросов за сутки """
+    """ Количество выполненных запросов за последние сутки.
+        Считается по request, а не по дневной статистике: записи за двое суток не удаляются,
+        а статистика считается по календарным дням и отстает на interval секунд
+    """
 
     with session_local() as sess:
         time_threshold = datetime.now() - timedelta(days=1)
-        amount = (sess.query(Request)
+        amount = (sess.query(func.count(Request.id))
                   .filter(Request.date_time >= time_threshold)
-                  .count())
+                  .scalar())
         return amount
 
 
@@ -254,5 +619,391 @@ def users_id_with_mailing() -> list:
 
     with session_local() as sess:
         users = sess.query(User).filter(User.mailing == True)
-    users_id = [user.user_telegram_id for user in users]
+        users_id = [user.user_telegram_id for user in users]
     return users_id
+
+
+def users_id_with_mailing_batch(after_id: int, limit: int) -> list:
+    """ Пачка пользователей с рассылкой, у которых id больше after_id: список (id, telegram id) """
+
+    with session_local() as sess:
+        rows = (sess.query(User.id, User.user_telegram_id)
+                .filter(User.mailing == True, User.id > after_id)
+                .order_by(User.id)
+                .limit(limit))
+        return [tuple(row) for row in rows]
+
+
+def get_movie_cache(key: str):
+    """ Актуальная запись кэша по нормализованному названию и году: (imdbID, данные фильма, expires_at).
+        Данные берутся из film, в старых записях movie_cache они хранятся в самой записи
+    """
+
+    with session_local() as sess:
+        return (sess.query(MovieCache.imdbID,
+                           func.coalesce(Film.data, MovieCache.data, type_=JSON).label('data'),
+                           MovieCache.expires_at)
+                .outerjoin(Film, Film.imdbID == MovieCache.imdbID)
+                .filter(MovieCache.key == key, MovieCache.expires_at > datetime.now())
+                .first())
+
+
+def get_film(imdb_id: str):
+    """ Актуальный фильм по imdbID: (imdbID, данные фильма, expires_at) """
+
+    with session_local() as sess:
+        film = (sess.query(Film.imdbID, Film.data, Film.expires_at)
+                .filter(Film.imdbID == imdb_id, Film.expires_at > datetime.now())
+                .first())
+        if film is not None:
+            return film
+        return (sess.query(MovieCache.imdbID, MovieCache.data, MovieCache.expires_at)  # Записи до появления film
+                .filter(MovieCache.imdbID == imdb_id, MovieCache.data.isnot(None),
+                        MovieCache.expires_at > datetime.now())
+                .order_by(MovieCache.expires_at.desc())
+                .first())
+
+
+def _upsert_film(sess: Session, imdb_id: str, data: dict, expires_at: datetime) -> None:
+    stmt = pg_insert(Film).values(imdbID=imdb_id, data=data, updated_at=datetime.now(), expires_at=expires_at)
+    sess.execute(stmt.on_conflict_do_update(index_elements=[Film.imdbID],
+                                            set_={'data': stmt.excluded.data,
+                                                  'updated_at': stmt.excluded.updated_at,
+                                                  'expires_at': stmt.excluded.expires_at}))
+
+
+def set_film(imdb_id: str, data: dict, expires_at: datetime) -> None:
+    """ Добавление или обновление фильма """
+
+    with session_local() as sess, sess.begin():
+        _upsert_film(sess, imdb_id, data, expires_at)
+
+
+def set_movie_cache(key: str, imdb_id: Optional[str], data: Optional[dict], expires_at: datetime) -> None:
+    """ Добавление или обновление записи кэша. Данные фильма сохраняются в film по imdbID """
+
+    with session_local() as sess, sess.begin():
+        if imdb_id and data is not None:
+            _upsert_film(sess, imdb_id, data, expires_at)
+        sess.merge(MovieCache(key=key, imdbID=imdb_id, data=None, expires_at=expires_at))
+
+
+def delete_expired_movie_cache() -> int:
+    """ Удаление устаревших записей кэша и фильмов """
+
+    with session_local() as sess, sess.begin():
+        now = datetime.now()
+        deleted = sess.execute(delete(MovieCache).where(MovieCache.expires_at <= now)).rowcount
+        return deleted + sess.execute(delete(Film).where(Film.expires_at <= now)).rowcount
+
+
+def get_poster_file_id(imdb_id: str) -> Optional[str]:
+    """ file_id постера фильма в Telegram """
+
+    with session_local() as sess:
+        return sess.query(PosterFile.file_id).filter(PosterFile.imdbID == imdb_id).scalar()
+
+
+def set_poster_file_id(imdb_id: str, file_id: str) -> None:
+    """ Добавление или обновление file_id постера """
+
+    with session_local() as sess, sess.begin():
+        stmt = pg_insert(PosterFile).values(imdbID=imdb_id, file_id=file_id, updated_at=datetime.now())
+        sess.execute(stmt.on_conflict_do_update(index_elements=[PosterFile.imdbID],
+                                                set_={'file_id': stmt.excluded.file_id,
+                                                      'updated_at': stmt.excluded.updated_at}))
+
+
+def delete_poster_file_id(imdb_id: str) -> None:
+    """ Удаление file_id, который Telegram больше не принимает """
+
+    with session_local() as sess, sess.begin():
+        sess.execute(delete(PosterFile).where(PosterFile.imdbID == imdb_id))
+
+
+def get_omdb_key_usage(day: date) -> dict:
+    """ Запросы ключей OMDb за сутки: id ключа -> (запросы, исчерпан ли лимит) """
+
+    with session_local() as sess:
+        rows = sess.query(OmdbKeyUsage.key_id, OmdbKeyUsage.requests, OmdbKeyUsage.exhausted).filter(
+            OmdbKeyUsage.day == day)
+        return {key_id: (requests, exhausted) for key_id, requests, exhausted in rows}
+
+
+def save_omdb_key_usage(rows: list) -> None:
+    """ Сохранение счетчиков ключей OMDb: список словарей key_id, day, requests, exhausted """
+
+    with session_local() as sess, sess.begin():
+        stmt = pg_insert(OmdbKeyUsage).values(rows)
+        sess.execute(stmt.on_conflict_do_update(
+            index_elements=[OmdbKeyUsage.key_id, OmdbKeyUsage.day],
+            set_={'requests': func.greatest(OmdbKeyUsage.requests, stmt.excluded.requests),
+                  'exhausted': OmdbKeyUsage.exhausted | stmt.excluded.exhausted}))
+
+
+def create_mailing_run(imdb_id: str, text: str) -> int:
+    """ Создание новой рассылки, возвращает ее id """
+
+    with session_local() as sess:
+        run = MailingRun(imdbID=imdb_id, text=text, started_at=datetime.now())
+        sess.add(run)
+        sess.commit()
+        return run.id
+
+
+def get_unfinished_mailing_run() -> Optional[MailingRun]:
+    """ Последняя незавершенная рассылка """
+
+    with session_local() as sess:
+        return (sess.query(MailingRun)
+                .filter(MailingRun.finished_at.is_(None))
+                .order_by(MailingRun.id.desc())
+                .first())
+
+
+def finish_mailing_run(run_id: int) -> None:
+    """ Отметка о завершении рассылки """
+
+    with session_local() as sess:
+        sess.execute(update(MailingRun).where(MailingRun.id == run_id).values(finished_at=datetime.now()))
+        sess.commit()
+
+
+def add_mailing_deliveries(run_id: int, deliveries: list) -> None:
+    """ Сохранение результатов отправки: список (telegram id, статус, ошибка, время).
+        Уже сохраненные результаты пропускаются, поэтому после ошибки пачку можно сохранить повторно
+    """
+
+    if not deliveries:
+        return
+    with session_local() as sess:
+        sess.execute(pg_insert(MailingDelivery).on_conflict_do_nothing(), [
+            {'run_id': run_id, 'telegram_id': telegram_id, 'status': status,
+             'error': error[:200] if error else None, 'date_time': date_time}
+            for telegram_id, status, error, date_time in deliveries
+        ])
+        sess.commit()
+
+
+def delivered_telegram_ids(run_id: int, telegram_ids: list) -> set:
+    """ Telegram id из списка, которым рассылка уже обработана """
+
+    with session_local() as sess:
+        rows = sess.query(MailingDelivery.telegram_id).filter(MailingDelivery.run_id == run_id,
+                                                              MailingDelivery.telegram_id.in_(telegram_ids))
+        return {telegram_id for telegram_id, in rows}
+
+
+def disable_mailing(telegram_ids: list) -> None:
+    """ Выключение рассылки у пользователей, заблокировавших бота """
+
+    if not telegram_ids:
+        return
+    with session_local() as sess:
+        sess.execute(update(User).where(User.user_telegram_id.in_(telegram_ids)).values(mailing=False))
+        sess.commit()
+
+
+def _upsert_counts(sess: Session, table, keys: list, source, counts: dict) -> None:
+    """ Прибавление количеств из запроса source к строкам table """
+
+    stmt = pg_insert(table).from_select(keys + list(counts), source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={column: getattr(table, column) + getattr(stmt.excluded, column)
+              for column, increment in counts.items() if increment}
+    )
+    sess.execute(stmt)
+
+
+def _rollup_watermark(sess: Session, name: str, model) -> tuple:
+    """ Диапазон id (после last_id, до max_id включительно), еще не учтенный в статистике.
+        Таблица должна быть заблокирована от вставок, см. rollup_requests
+    """
+
+    state = sess.query(RollupState).filter(RollupState.name == name).with_for_update().first()
+    if state is None:
+        state = RollupState(name=name, last_id=0)
+        sess.add(state)
+    last_id = state.last_id
+    max_id = sess.query(func.max(model.id)).scalar() or 0
+    state.last_id = max(last_id, max_id)
+    return last_id, max_id
+
+
+def rollup_requests(since: Optional[date] = None) -> dict:
+    """ Добавление новых записей request и bad_request в дневную статистику, при since - только с этого дня.
+        Возвращает учтенные диапазоны id: (после id, до id включительно)
+    """
+
+    with session_local() as sess, sess.begin():
+        # Блокировка дожидается незавершенных вставок и не дает начать новые до конца транзакции.
+        # Без нее запись с меньшим id, зафиксированная другим процессом после чтения max(id), не попала бы в статистику
+        sess.execute(text(f'LOCK TABLE "{Request.__tablename__}", "{BadRequest.__tablename__}" IN SHARE MODE'))
+        last_id, max_id = _rollup_watermark(sess, 'request', Request)
+        requests = (last_id, max_id)
+        if max_id > last_id:
+            day = cast(Request.date_time, Date)
+            new = (Request.id > last_id, Request.id <= max_id, *((day >= since,) if since else ()))
+            _upsert_counts(sess, RequestDaily, ['day', 'user_id'],
+                           select(day, Request.user_id, func.count(), literal(0)).where(*new)
+                           .group_by(day, Request.user_id),
+                           {'requests': True, 'bad_requests': False})
+            _upsert_counts(sess, FilmDaily, ['day', 'imdbID'],
+                           select(day, Request.imdbID, func.count()).where(*new).group_by(day, Request.imdbID),
+                           {'requests': True})
+            _upsert_counts(sess, DailyTotal, ['day'],
+                           select(day, func.count(), literal(0)).where(*new).group_by(day),
+                           {'requests': True, 'bad_requests': False})
+
+        last_id, max_id = _rollup_watermark(sess, 'bad_request', BadRequest)
+        bad_requests = (last_id, max_id)
+        if max_id > last_id:
+            day = cast(BadRequest.date_time, Date)
+            new = (BadRequest.id > last_id, BadRequest.id <= max_id, *((day >= since,) if since else ()))
+            _upsert_counts(sess, RequestDaily, ['day', 'user_id'],
+                           select(day, BadRequest.user_id, literal(0), func.count()).where(*new)
+                           .group_by(day, BadRequest.user_id),
+                           {'requests': False, 'bad_requests': True})
+            _upsert_counts(sess, DailyTotal, ['day'],
+                           select(day, literal(0), func.count()).where(*new).group_by(day),
+                           {'requests': False, 'bad_requests': True})
+        return {'request': requests, 'bad_request': bad_requests}
+
+
+def complete_requests_since() -> Optional[date]:
+    """ Первый день, за который в request и bad_request есть все записи.
+        None - старые записи не удалялись. Удаление видно по отметке в rollup_state
+        или по статистике за дни раньше самой старой записи. День самой старой записи мог быть удален частично
+    """
+
+    with session_local() as sess:
+        state = dict(sess.query(RollupState.name, RollupState.last_id))
+        since = None
+        for name, model, counted in (('request', Request, DailyTotal.requests),
+                                     ('bad_request', BadRequest, DailyTotal.bad_requests)):
+            first = sess.query(func.min(model.date_time)).scalar()
+            first_rollup = sess.query(func.min(DailyTotal.day)).filter(counted > 0).scalar()
+            if first is None:
+                deleted = bool(state.get(f'{name}_retention'))  # Пустая таблица без отметки - записей еще не было
+                first = datetime.now()
+            else:
+                deleted = state.get(f'{name}_retention') or (first_rollup is not None and first_rollup < first.date())
+            if deleted:
+                day = first.date() + timedelta(days=1)
+                since = max(since, day) if since else day
+        return since
+
+
+def reset_rollups(since: Optional[date] = None) -> None:
+    """ Очистка дневной статистики для пересчета, при since - только начиная с этого дня """
+
+    with session_local() as sess, sess.begin():
+        for model in (RequestDaily, FilmDaily, DailyTotal):
+            sess.execute(delete(model).where(*((model.day >= since,) if since else ())))
+        sess.execute(delete(RollupState).where(RollupState.name.in_(('request', 'bad_request'))))
+
+
+def delete_old_requests(before: datetime) -> dict:
+    """ Удаление записей request и bad_request старше before, уже учтенных в дневной статистике """
+
+    with session_local() as sess, sess.begin():
+        watermarks = dict(sess.query(RollupState.name, RollupState.last_id))
+        deleted = {}
+        for name, model in (('request', Request), ('bad_request', BadRequest)):
+            deleted[name] = sess.execute(delete(model).where(model.date_time < before,
+                                                             model.id <= watermarks.get(name, 0))).rowcount
+            if deleted[name]:
+                sess.merge(RollupState(name=f'{name}_retention', last_id=watermarks[name]))
+        return deleted
+
+
+def top_films(since: date, limit: int = 10) -> list:
+    """ Самые запрашиваемые фильмы начиная с дня since: список (imdbID, количество запросов) """
+
+    with session_local() as sess:
+        total = func.sum(FilmDaily.requests).label('total')
+        rows = (sess.query(FilmDaily.imdbID, total)
+                .filter(FilmDaily.day >= since)
+                .group_by(FilmDaily.imdbID)
+                .order_by(total.desc())
+                .limit(limit))
+        return [(imdb_id, int(amount)) for imdb_id, amount in rows]
+
+
+def cached_titles() -> list:
+    """ Найденные фильмы из movie_cache: список (imdbID, ключ кэша, название, год) """
+
+    with session_local() as sess:
+        rows = (sess.query(MovieCache.imdbID, MovieCache.key,
+                           func.coalesce(Film.data['Title'].as_string(), MovieCache.data['Title'].as_string()),
+                           func.coalesce(Film.data['Year'].as_string(), MovieCache.data['Year'].as_string()))
+                .outerjoin(Film, Film.imdbID == MovieCache.imdbID)
+                .filter(MovieCache.imdbID.isnot(None)))
+        return [tuple(row) for row in rows if row[2] is not None]
+
+
+def request_counts() -> dict:
+    """ Количество успешных запросов каждого фильма: imdbID -> количество """
+
+    with session_local() as sess:
+        return dict(sess.query(Request.imdbID, func.count(Request.id)).group_by(Request.imdbID))
+
+
+def import_catalog_titles(titles: list, names: list) -> None:
+    """ Добавление или обновление пачки фильмов каталога и их названий """
+
+    with session_local() as sess, sess.begin():
+        stmt = pg_insert(CatalogTitle).values(titles)
+        sess.execute(stmt.on_conflict_do_update(
+            index_elements=[CatalogTitle.imdbID],
+            set_={'title': stmt.excluded.title, 'year': stmt.excluded.year, 'kind': stmt.excluded.kind}))
+        if names:
+            sess.execute(pg_insert(CatalogName).values(names).on_conflict_do_nothing())
+
+
+def import_catalog_names(names: list) -> int:
+    """ Добавление локализованных названий (imdbID, нормализованное название) для фильмов, которые есть в каталоге.
+        Возвращает количество добавленных названий
+    """
+
+    source = values(column('imdbID', String), column('normalized_title', String),
+                    name='source').data(names)
+    query = (select(source.c.imdbID, source.c.normalized_title, CatalogTitle.year)
+             .join(CatalogTitle, CatalogTitle.imdbID == source.c.imdbID))
+    with session_local() as sess, sess.begin():
+        result = sess.execute(pg_insert(CatalogName)
+                              .from_select(['imdbID', 'normalized_title', 'year'], query)
+                              .on_conflict_do_nothing())
+        return result.rowcount
+
+
+def import_catalog_ratings(ratings: list) -> None:
+    """ Добавление или обновление количества голосов """
+
+    with session_local() as sess, sess.begin():
+        stmt = pg_insert(CatalogRating).values(ratings)
+        sess.execute(stmt.on_conflict_do_update(index_elements=[CatalogRating.imdbID],
+                                                set_={'votes': stmt.excluded.votes}))
+
+
+def find_catalog_title(normalized_title: str, year: Optional[int] = None, limit: int = 2) -> list:
+    """ Фильмы каталога с таким названием: список (imdbID, количество голосов или None),
+        самые популярные первыми
+    """
+
+    with session_local() as sess:
+        query = (sess.query(CatalogName.imdbID, CatalogRating.votes)
+                 .outerjoin(CatalogRating, CatalogRating.imdbID == CatalogName.imdbID)
+                 .filter(CatalogName.normalized_title == normalized_title))
+        if year is not None:
+            query = query.filter(CatalogName.year == year)
+        rows = query.order_by(CatalogRating.votes.desc().nullslast()).limit(limit)
+        return [tuple(row) for row in rows]
+
+
+def catalog_size() -> int:
+    """ Количество фильмов в каталоге """
+
+    with session_local() as sess:
+        return sess.query(func.count(CatalogTitle.imdbID)).scalar()
@@ -0,0 +1,82 @@
+""" Время обработки команд бота с разбивкой по этапам: OMDb, база данных, отправка в Telegram.
+    Обработчик, обернутый в instrument, получает в contextvars словарь этапов.
+    Код этапа оборачивается в phase, время этапа прибавляется к словарю текущей команды.
+    Задачи, созданные во время обработки команды, копируют контекст и пишут в тот же словарь
+"""
+
+import contextvars
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from telegram.request import HTTPXRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+handler_duration = metrics.histogram('bot_handler_duration_seconds',
+                                     'Время обработки команды по этапам, этап total - полное время',
+                                     ('handler', 'phase'))
+handler_errors = metrics.counter('bot_handler_errors_total', 'Необработанные ошибки в обработчиках',
+                                 ('handler', 'error'))
+telegram_duration = metrics.histogram('telegram_request_duration_seconds', 'Время запросов к Bot API',
+                                      ('method',))
+
+_phases: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar('phases', default=None)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """ Учет времени этапа в текущей команде. Вне команды ничего не учитывается """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = _phases.get()
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def instrument(name: str):
+    """ Декоратор обработчика или задачи планировщика: время по этапам и счетчик ошибок.
+        Ставится над check_user, чтобы учитывались и запросы неавторизованных пользователей
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            phases = {}
+            token = _phases.set(phases)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:  # Сама ошибка попадает в журнал через обработчик ошибок Application
+                handler_errors.labels(handler=name, error=type(e).__name__).inc()
+                raise
+            finally:
+                total = time.perf_counter() - start
+                _phases.reset(token)
+                handler_duration.labels(handler=name, phase='total').observe(total)
+                for phase_name, value in phases.items():
+                    handler_duration.labels(handler=name, phase=phase_name).observe(value)
+                logger.debug('%s обработан', name,
+                             extra={'duration': round(total, 4),
+                                    **{phase_name: round(value, 4) for phase_name, value in phases.items()}})
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """ Запросы к Bot API с учетом времени этапа telegram и гистограммой по методам """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with phase('telegram'):
+                return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_duration.labels(method=url.rsplit('/', 1)[-1]).observe(time.perf_counter() - start)
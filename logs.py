@@ -0,0 +1,94 @@
+""" Настройка журнала работы бота.
+    Обработчики только кладут запись в очередь, вывод в консоль и файл выполняет
+    отдельный поток QueueListener, поэтому запись журнала не блокирует цикл событий
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from configparser import ConfigParser
+from typing import Optional
+
+config = ConfigParser()
+config.read('config.ini')
+LEVEL = config.get('logging', 'level', fallback='INFO')
+FORMAT = config.get('logging', 'format', fallback='text')  # text или json
+FILE = config.get('logging', 'file', fallback='')  # Пусто - только вывод в консоль
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+QUIET_LOGGERS = ('httpx', 'apscheduler', 'aiohttp.access')
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _fields(record: logging.LogRecord) -> dict:
+    """ Дополнительные поля записи, переданные через extra """
+
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED}
+
+
+class TextFormatter(logging.Formatter):
+    """ [2024-01-01 12:00:00] | INFO | bot | /start | user_id=1 """
+
+    def __init__(self):
+        super().__init__('[%(asctime)s] | %(levelname)s | %(name)s | %(message)s', DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        output = super().format(record)
+        fields = _fields(record)
+        if fields:
+            output += ' | ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return output
+
+
+class JsonFormatter(logging.Formatter):
+    """ Одна запись - одна строка JSON, для сбора журнала внешними системами """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'time': self.formatTime(record, DATE_FORMAT),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage()}
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        data.update(_fields(record))
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup(level: str = LEVEL, output_format: str = FORMAT, file: str = FILE) -> None:
+    """ Подключение очереди к корневому логгеру и запуск потока вывода. Повторный вызов ничего не делает """
+
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if output_format == 'json' else TextFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if file:
+        handlers.append(logging.FileHandler(file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level.upper())
+    for name in QUIET_LOGGERS:  # Иначе каждый HTTP запрос и запуск задачи попадает в журнал
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """ Вывод оставшихся записей и остановка потока """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    _listener = None
@@ -0,0 +1,230 @@
+""" Рассылка сообщений пользователям с ограничением скорости отправки """
+
+import asyncio
+import datetime
+import logging
+import time
+from configparser import ConfigParser
+from typing import AsyncIterable, AsyncIterator, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import async_database
+import posters
+import whitelist
+
+config = ConfigParser()
+config.read('config.ini')
+CONCURRENCY = config.getint('mailing', 'concurrency', fallback=20)
+RATE = config.getfloat('mailing', 'rate', fallback=25)  # Сообщений в секунду на всех, лимит Telegram ~30
+PER_CHAT_INTERVAL = config.getfloat('mailing', 'per_chat_interval', fallback=1)  # Секунд между сообщениями в чат
+MAX_RETRIES = config.getint('mailing', 'max_retries', fallback=5)
+CHECKPOINT_SIZE = config.getint('mailing', 'checkpoint_size', fallback=25)
+# Секунд между сохранениями результатов
+CHECKPOINT_INTERVAL = config.getfloat('mailing', 'checkpoint_interval', fallback=1)
+
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """ Ограничение количества операций в секунду (token bucket).
+        pause() приостанавливает все операции, например после RetryAfter от Telegram
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcast:
+    """ Отправка одного сообщения списку получателей.
+        Сообщения отправляются параллельно, но не быстрее лимитов Telegram.
+        Результаты сохраняются в mailing_delivery пачками не реже раза в checkpoint_interval секунд, поэтому
+        прерванная рассылка продолжается с места остановки: повторно сообщение получат не больше
+        checkpoint_size + concurrency человек. Если база недоступна, результаты сохраняются при следующей пачке,
+        а отправка продолжается. Пользователям, заблокировавшим бота, рассылка выключается.
+        Фильм с постером отправляется фотографией: если постер еще не загружен в Telegram, первые сообщения
+        отправляются по одному, пока не получен file_id, остальным фотография отправляется по file_id
+    """
+
+    def __init__(self, bot: Bot, run_id: int, text: str, film: Optional[dict] = None, photo: Optional[str] = None,
+                 concurrency: int = CONCURRENCY, rate: float = RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 max_retries: int = MAX_RETRIES, checkpoint_size: int = CHECKPOINT_SIZE,
+                 checkpoint_interval: float = CHECKPOINT_INTERVAL):
+        self.bot = bot
+        self.run_id = run_id
+        self.text = text
+        self.film = film  # Ответ api.make_answer, нужен для отправки фотографией
+        self.photo = photo  # file_id или ссылка на постер, None - отправка текстом
+        self.max_retries = max_retries
+        self.per_chat_interval = per_chat_interval
+        self.checkpoint_size = checkpoint_size
+        self.checkpoint_interval = checkpoint_interval
+        self._checkpointed = time.monotonic()
+        self.limiter = RateLimiter(rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._last_sent = {}  # telegram id -> время последней отправки
+        self._results = []
+        self.counts = {SENT: 0, BLOCKED: 0, FAILED: 0}
+
+    async def run(self, recipients: AsyncIterable[int]) -> dict:
+        """ Отправка всем получателям, возвращает количество сообщений по статусам """
+
+        tasks = set()
+        async for telegram_id in recipients:
+            await self._semaphore.acquire()  # Не создаем задачи для всех получателей сразу
+            if self._uploading():
+                await self._deliver(telegram_id)
+            else:
+                task = asyncio.create_task(self._deliver(telegram_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(self._results) >= self.checkpoint_size or (
+                    self._results and time.monotonic() - self._checkpointed >= self.checkpoint_interval):
+                await self.checkpoint()
+        if tasks:
+            await asyncio.gather(*tasks)
+        if not await self.checkpoint():
+            raise RuntimeError('Результаты рассылки не сохранены, рассылка будет продолжена позже')
+        return self.counts
+
+    async def checkpoint(self) -> bool:
+        """ Сохранение накопленных результатов отправки. Если база недоступна, результаты остаются
+            до следующего сохранения. Возвращает, сохранены ли все результаты
+        """
+
+        results, self._results = self._results, []
+        self._checkpointed = time.monotonic()
+        if not results:
+            return True
+        try:
+            await async_database.add_mailing_deliveries(self.run_id, results)
+        except Exception:
+            logger.exception('Не удалось сохранить результаты рассылки', extra={'run_id': self.run_id})
+            self._results = results + self._results
+            return False
+        blocked = [telegram_id for telegram_id, status, _, _ in results if status == BLOCKED]
+        if blocked:
+            for telegram_id in blocked:
+                whitelist.users.set_mailing(telegram_id, False)
+            try:
+                await async_database.disable_mailing(blocked)
+            except Exception:  # Следующая рассылка снова получит Forbidden и повторит выключение
+                logger.exception('Не удалось выключить рассылку', extra={'run_id': self.run_id})
+        return True
+
+    def _uploading(self) -> bool:
+        """ Постер еще не загружен в Telegram """
+
+        return self.photo is not None and self.photo.startswith('http')
+
+    async def _deliver(self, telegram_id: int) -> None:
+        try:
+            status, error = await self._send(telegram_id)
+        except Exception as e:
+            logger.exception('Ошибка отправки рассылки', extra={'run_id': self.run_id, 'user_id': telegram_id})
+            status, error = FAILED, repr(e)
+        finally:
+            self._semaphore.release()
+        self.counts[status] += 1
+        self._results.append((telegram_id, status, error, datetime.datetime.now()))
+
+    async def _send(self, telegram_id: int) -> Tuple[str, Optional[str]]:
+        """ Отправка одному получателю с повторами при превышении лимита и ошибках сети """
+
+        error = None
+        for attempt in range(self.max_retries):
+            wait = self._last_sent.get(telegram_id, 0) + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.limiter.acquire()
+            photo = self.photo
+            try:
+                if photo is not None:
+                    message = await self.bot.send_photo(telegram_id, photo, caption=self.film['caption'])
+                else:
+                    message = await self.bot.send_message(telegram_id, self.text)
+            except RetryAfter as e:
+                logger.warning('Превышен лимит Telegram, пауза %s с', e.retry_after, extra={'run_id': self.run_id})
+                self.limiter.pause(e.retry_after)
+                error = str(e)
+            except Forbidden as e:  # Пользователь заблокировал бота
+                return BLOCKED, str(e)
+            except BadRequest as e:  # Например, чат не найден
+                if photo is None or not posters.is_photo_error(e):
+                    return FAILED, str(e)
+                logger.warning('Постер не отправлен: %s', e.message, extra={'run_id': self.run_id})
+                if self.photo == photo:
+                    self.photo = await posters.store.failed(self.film['imdbID'], photo, self.film['poster'])
+                error = str(e)
+            except NetworkError as e:
+                error = str(e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+            else:
+                self._last_sent[telegram_id] = time.monotonic()
+                if photo is not None:
+                    await self._remember(photo, message)
+                return SENT, None
+        return FAILED, error
+
+    async def _remember(self, photo: str, message) -> None:
+        """ file_id отправленной фотографии для следующих получателей. Сообщение уже доставлено,
+            поэтому ошибка здесь не меняет статус получателя
+        """
+
+        try:
+            self.photo = await posters.remember(self.film['imdbID'], photo, message) or photo
+        except Exception:
+            logger.exception('Не удалось сохранить file_id постера', extra={'run_id': self.run_id})
+
+
+_lock = asyncio.Lock()
+
+
+async def recipients(run_id: int) -> AsyncIterator[int]:
+    """ Пользователи с включенной рассылкой, кроме уже обработанных в этой рассылке """
+
+    async for batch in async_database.iter_users_id_with_mailing():
+        delivered = await async_database.delivered_telegram_ids(run_id, batch)
+        for telegram_id in batch:
+            if telegram_id not in delivered:
+                yield telegram_id
+
+
+async def send_mailing(bot: Bot, run_id: int, text: str, film: Optional[dict] = None) -> dict:
+    """ Рассылка всем пользователям с включенной рассылкой.
+        Получатели читаются из базы пачками, отправка начинается после загрузки первой пачки.
+        film - ответ api.make_answer, если у фильма есть постер, он отправляется фотографией с подписью
+    """
+
+    async with _lock:  # Одна рассылка за раз
+        photo = await posters.store.photo(film['imdbID'], film.get('poster')) if film is not None else None
+        counts = await Broadcast(bot, run_id, text, film, photo).run(recipients(run_id))
+        await async_database.finish_mailing_run(run_id)
+        return counts
@@ -0,0 +1,224 @@
+""" Метрики работы бота: счетчики, текущие значения и гистограммы.
+    Метрики обновляются и из потоков пула базы данных, поэтому изменения защищены блокировкой.
+    Выгрузка в текстовом формате Prometheus: /metrics на сервере вебхука или на отдельном порту из [metrics]
+"""
+
+import logging
+import threading
+from bisect import bisect_left
+from configparser import ConfigParser
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+config = ConfigParser()
+config.read('config.ini')
+LISTEN = config.get('metrics', 'listen', fallback='127.0.0.1')
+PORT = config.getint('metrics', 'port', fallback=0)  # 0 - отдельный сервер метрик не запускается
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """ Базовая метрика с поддержкой меток """
+
+    kind = ''
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels) -> 'Metric':
+        """ Метрика с конкретными значениями меток """
+
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def children(self) -> Dict[tuple, 'Metric']:
+        """ Значения метрики по меткам. Для метрики без меток - одно значение с пустым ключом """
+
+        if not self.labelnames:
+            return {(): self}
+        return dict(self._children)
+
+    def _new_child(self) -> 'Metric':
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """ Монотонно растущий счетчик """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, description, labelnames)
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def _new_child(self) -> 'Counter':
+        return Counter(self.name, self.description)
+
+
+class Gauge(Metric):
+    """ Текущее значение """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, description, labelnames)
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def _new_child(self) -> 'Gauge':
+        return Gauge(self.name, self.description)
+
+
+class Histogram(Metric):
+    """ Распределение значений по корзинам, например длительности в секундах """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _new_child(self) -> 'Histogram':
+        return Histogram(self.name, self.description, buckets=self.buckets)
+
+
+registry: Dict[str, Metric] = {}
+
+
+def _register(metric: Metric) -> Metric:
+    return registry.setdefault(metric.name, metric)
+
+
+def counter(name: str, description: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    """ Создание или получение зарегистрированного счетчика """
+
+    return _register(Counter(name, description, labelnames))
+
+
+def gauge(name: str, description: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    """ Создание или получение зарегистрированного значения """
+
+    return _register(Gauge(name, description, labelnames))
+
+
+def histogram(name: str, description: str, labelnames: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """ Создание или получение зарегистрированной гистограммы """
+
+    return _register(Histogram(name, description, labelnames, buckets))
+
+
+_collectors: List[Callable[[], None]] = []
+
+
+def on_collect(callback: Callable[[], None]) -> None:
+    """ Функция, обновляющая значения метрик перед выгрузкой, например из статистики кэшей """
+
+    if callback not in _collectors:
+        _collectors.append(callback)
+
+
+def _format_labels(labelnames: Tuple[str, ...], key: tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """ Все зарегистрированные метрики в текстовом формате Prometheus """
+
+    for callback in _collectors:
+        callback()
+    lines = []
+    for metric in registry.values():
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for key, child in sorted(metric.children().items()):
+            if isinstance(child, Histogram):
+                cumulative = 0
+                for bound, count in zip(child.buckets + (float('inf'),), child.counts):
+                    cumulative += count
+                    labels = _format_labels(metric.labelnames, key, (('le', _format_value(bound)),))
+                    lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(metric.labelnames, key)
+                lines.append(f'{metric.name}_sum{labels} {_format_value(child.sum)}')
+                lines.append(f'{metric.name}_count{labels} {child.count}')
+            else:
+                lines.append(f'{metric.name}{_format_labels(metric.labelnames, key)} {_format_value(child.value)}')
+    return '\n'.join(lines) + '\n'
+
+
+async def handle(request: web.Request) -> web.Response:
+    """ Обработчик HTTP запроса /metrics """
+
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def start_server(listen: str = LISTEN, port: int = PORT) -> None:
+    """ Отдельный HTTP сервер с метриками. port = 0 - сервер не запускается """
+
+    global _runner
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, listen, port).start()
+    logger.info('Метрики доступны на %s:%s/metrics', listen, port)
+
+
+async def stop_server() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+    _runner = None
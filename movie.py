@@ -0,0 +1,121 @@
+""" Компактная запись о фильме из ответа OMDb """
+
+from typing import Optional
+
+NA = 'N/A'  # Один объект строки на все пустые поля
+CAPTION_LIMIT = 1024  # Максимальная длина подписи к фотографии в Telegram
+
+# Атрибут записи -> поле ответа OMDb
+FIELDS = (
+    ('title', 'Title'),
+    ('year', 'Year'),
+    ('plot', 'Plot'),
+    ('type', 'Type'),
+    ('rated', 'Rated'),
+    ('released', 'Released'),
+    ('runtime', 'Runtime'),
+    ('genre', 'Genre'),
+    ('director', 'Director'),
+    ('writer', 'Writer'),
+    ('actors', 'Actors'),
+    ('country', 'Country'),
+    ('awards', 'Awards'),
+    ('box_office', 'BoxOffice'),
+    ('poster', 'Poster'),
+)
+
+# Атрибут записи -> источник рейтинга в Ratings
+RATINGS = (
+    ('imdb_rating', 'Internet Movie Database'),
+    ('rotten_tomatoes', 'Rotten Tomatoes'),
+    ('metacritic', 'Metacritic'),
+)
+
+
+def _value(value: Optional[str]) -> str:
+    return NA if not value or value == NA else value
+
+
+class Movie:
+    """ Фильм из ответа OMDb: только поля, которые показываются пользователю.
+        Ответ OMDb разбирается один раз, текст ответа бота формируется при первом обращении
+        и хранится в записи, а запись хранится в кэше по imdbID
+    """
+
+    __slots__ = (('imdb_id',) + tuple(name for name, _ in FIELDS) + tuple(name for name, _ in RATINGS)
+                 + ('_text', '_caption'))
+
+    def __init__(self, imdb_id: str, **fields):
+        self.imdb_id = imdb_id
+        for name, _ in FIELDS + RATINGS:
+            setattr(self, name, _value(fields.get(name)))
+        self._text = None
+        self._caption = None
+
+    @classmethod
+    def from_omdb(cls, data: dict) -> 'Movie':
+        """ Запись из ответа OMDb. Рейтинги сопоставляются по Source, а не по порядку в списке """
+
+        film = cls.__new__(cls)
+        film.imdb_id = data['imdbID']
+        for name, key in FIELDS:
+            setattr(film, name, _value(data.get(key)))
+        ratings = {rating.get('Source'): rating.get('Value') for rating in data.get('Ratings') or ()}
+        for name, source in RATINGS:
+            setattr(film, name, _value(ratings.get(source)))
+        film._text = None
+        film._caption = None
+        return film
+
+    def to_omdb(self) -> dict:
+        """ Поля записи в формате ответа OMDb, для хранения в movie_cache """
+
+        data = {key: getattr(self, name) for name, key in FIELDS}
+        data['imdbID'] = self.imdb_id
+        data['Ratings'] = [{'Source': source, 'Value': getattr(self, name)}
+                           for name, source in RATINGS if getattr(self, name) != NA]
+        return data
+
+    @property
+    def text(self) -> str:
+        """ Текст ответа бота """
+
+        if self._text is None:
+            self._text = (
+                f'Название: {self.title}\n'
+                f'Описание: {self.plot}\n'
+                f'Тип: {self.type}\n'
+                f'Возрастной рейтинг: {self.rated}\n'
+                f'Релиз: {self.released}\n'
+                f'Длительность: {self.runtime}\n'
+                f'Жанр: {self.genre}\n'
+                f'Режиссер: {self.director}\n'
+                f'Сценарий: {self.writer}\n'
+                f'Актеры: {self.actors}\n'
+                f'Страна: {self.country}\n'
+                f'Награды: {self.awards}\n'
+                f'Сборы: {self.box_office}\n'
+                f'Постер: {self.poster}\n'
+                f'Рейтинг:\n'
+                f'  IMD: {self.imdb_rating}\n'
+                f'  Rotten Tomatoes: {self.rotten_tomatoes}\n'
+                f'  Metacritic: {self.metacritic}\n'
+            )
+        return self._text
+
+    @property
+    def caption(self) -> str:
+        """ Текст ответа для подписи к постеру. Если он длиннее лимита Telegram, сокращается описание """
+
+        if self._caption is None:
+            text = self.text
+            excess = len(text) - CAPTION_LIMIT
+            if excess <= 0:
+                self._caption = text
+            else:
+                plot = self.plot[:max(len(self.plot) - excess - 1, 0)].rstrip() + '…'
+                self._caption = text.replace(f'Описание: {self.plot}\n', f'Описание: {plot}\n', 1)[:CAPTION_LIMIT]
+        return self._caption
+
+    def __repr__(self) -> str:
+        return f'Movie({self.imdb_id!r}, {self.title!r})'
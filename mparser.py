@@ -1,25 +1,89 @@
-from typing import Union
+""" Получение названий случайных фильмов с randomfilm """
 
-import requests
+import asyncio
+import logging
+import re
+from configparser import ConfigParser
+from typing import List, Optional
+
+import aiohttp
 from bs4 import BeautifulSoup
 
+config = ConfigParser()
+config.read('config.ini')
+URL = config.get('randomfilm', 'url', fallback='https://randomfilm.ru/')
+TIMEOUT = config.getfloat('randomfilm', 'timeout', fallback=10)
+CONCURRENCY = config.getint('randomfilm', 'concurrency', fallback=4)
 
-def parse_movie_info() -> Union[str, None]:
-    """ Получить название случайного фильма из randomfilm """
+logger = logging.getLogger(__name__)
+
+H2_START = re.compile(r'<h2[\s>]', re.IGNORECASE)
+H2_END = re.compile(r'</h2\s*>', re.IGNORECASE)
+
+_session: Optional[aiohttp.ClientSession] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+async def start_session() -> aiohttp.ClientSession:
+    """ Создание общей сессии для запросов к randomfilm """
+
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+    return _session
+
+
+async def close_session() -> None:
+    """ Закрытие общей сессии при остановке бота """
 
-    url = "https://randomfilm.ru/"
-    response = requests.get(url)
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
-    if response.status_code != 200:
-        print("Не удалось получить страницу.")
+
+def parse_title(html: str) -> Optional[str]:
+    """ Название фильма из первого заголовка h2.
+        Разбирается только фрагмент страницы с заголовком, а не вся страница
+    """
+
+    start = H2_START.search(html)
+    if start is None:
         return None
+    end = H2_END.search(html, start.end())
+    fragment = html[start.start():end.end() if end else None]
 
-    soup = BeautifulSoup(response.content, 'html.parser')
-    title_element = soup.find('h2')
+    title_element = BeautifulSoup(fragment, 'html.parser').h2
     if title_element:
         title = title_element.text.strip()
         parts = title.split('/')
         if len(parts) > 1:
             return parts[1].strip()
         return title
-    return
+    return None
+
+
+async def fetch_movie_title() -> Optional[str]:
+    """ Получить название случайного фильма из randomfilm """
+
+    session = await start_session()
+    async with _semaphore:
+        try:
+            async with session.get(URL) as response:
+                if response.status != 200:
+                    logger.warning('Не удалось получить страницу: статус %s', response.status)
+                    return None
+                html = await response.text(errors='replace')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning('Не удалось получить страницу: %r', e)
+            return None
+    return parse_title(html)
+
+
+async def fetch_movie_titles(count: int) -> List[str]:
+    """ Получить названия нескольких случайных фильмов параллельно """
+
+    titles = await asyncio.gather(*(fetch_movie_title() for _ in range(count)))
+    return [title for title in titles if title]
@@ -0,0 +1,200 @@
+""" Пул ключей OMDb.
+    У каждого ключа свой token bucket и счетчик запросов за сутки. Запрос выполняется ключом
+    с наименьшей долей использованного лимита, у которого есть свободный токен.
+    Ключ, исчерпавший лимит OMDb, не используется до конца суток, неверный ключ - park секунд.
+    Счетчики сохраняются в таблицу omdb_key_usage по хэшу ключа, сам ключ в базу не пишется
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from configparser import ConfigParser
+from datetime import date, datetime, timezone
+from typing import List, Optional
+
+import async_database
+import metrics
+
+config = ConfigParser()
+config.read('config.ini')
+_api_keys = config.get('ombd', 'api_keys', fallback=config.get('ombd', 'api_key', fallback=''))
+KEYS = [key.strip() for key in _api_keys.split(',') if key.strip()]
+RATE = config.getfloat('ombd', 'key_rate', fallback=10)  # Запросов в секунду на ключ, 0 - без ограничения
+BURST = config.getfloat('ombd', 'key_burst', fallback=20)
+MIN_RATE = config.getfloat('ombd', 'key_min_rate', fallback=1)  # Ниже этого скорость при ответах 429 и 5xx не снижается
+DAILY_LIMIT = config.getint('ombd', 'key_daily_limit', fallback=0)  # Запросов в сутки на ключ, 0 - без ограничения
+PARK = config.getint('ombd', 'key_park', fallback=3600)  # Секунд, на которые откладывается неверный ключ
+FLUSH_INTERVAL = config.getint('ombd', 'usage_flush_interval', fallback=60)
+
+QUOTA_ERRORS = ('Request limit reached!',)
+INVALID_KEY_ERRORS = ('Invalid API key!', 'No API key provided.')
+
+logger = logging.getLogger(__name__)
+key_requests = metrics.gauge('omdb_key_requests', 'Запросы ключа OMDb за текущие сутки', ('key',))
+key_available = metrics.gauge('omdb_key_available', 'Ключ OMDb используется: 1 - да, 0 - отложен или лимит исчерпан',
+                              ('key',))
+
+
+def today() -> date:
+    """ Сутки лимита OMDb, по UTC """
+
+    return datetime.now(timezone.utc).date()
+
+
+class ApiKey:
+    """ Ключ OMDb: token bucket с адаптивной скоростью, счетчик запросов за сутки и время, до которого ключ отложен """
+
+    def __init__(self, value: str, rate: float = RATE, burst: float = BURST, daily_limit: int = DAILY_LIMIT):
+        self.value = value
+        self.id = hashlib.sha256(value.encode()).hexdigest()[:16]
+        self.label = f'...{value[-4:]}'  # Для журнала и метрик
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.day = today()
+        self.requests = 0
+        self.exhausted = False  # OMDb ответил, что лимит на сутки исчерпан
+        self.parked_until = 0.0
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _new_day(self) -> None:
+        day = today()
+        if day != self.day:
+            self.day, self.requests, self.exhausted = day, 0, False
+
+    def available(self, now: float) -> bool:
+        """ Ключ не отложен и лимит за сутки не исчерпан """
+
+        self._new_day()
+        if self.exhausted or now < self.parked_until:
+            return False
+        return not self.daily_limit or self.requests < self.daily_limit
+
+    def usage(self) -> float:
+        """ Доля использованного суточного лимита, без лимита - количество запросов """
+
+        return self.requests / self.daily_limit if self.daily_limit else self.requests
+
+    def wait(self, now: float) -> float:
+        """ Секунд до свободного токена, 0 - токен есть """
+
+        if not self.rate:
+            return 0
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate:
+            self._tokens -= 1
+        self.requests += 1
+
+    def slow_down(self) -> None:
+        """ OMDb не справляется (429, 5xx): скорость ключа уменьшается вдвое """
+
+        if self.rate:
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+    def speed_up(self) -> None:
+        """ Успешный ответ: скорость постепенно возвращается к заданной """
+
+        if self.rate and self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+class KeyPool:
+    """ Выбор ключа для запроса к OMDb и учет ответов """
+
+    def __init__(self, keys: List[str] = KEYS):
+        self.keys = [ApiKey(key) for key in keys]
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    async def acquire(self) -> Optional[ApiKey]:
+        """ Наименее загруженный ключ со свободным токеном. Если токенов нет - ожидание ближайшего.
+            None, если все ключи отложены или исчерпали лимит
+        """
+
+        while True:
+            now = time.monotonic()
+            keys = [key for key in self.keys if key.available(now)]
+            if not keys:
+                return None
+            ready = [key for key in keys if key.wait(now) == 0]
+            if ready:
+                key = min(ready, key=ApiKey.usage)
+                key.take()
+                self._dirty = True
+                return key
+            await asyncio.sleep(min(key.wait(now) for key in keys))
+
+    def report(self, key: ApiKey, status: int, error: Optional[str] = None) -> bool:
+        """ Учет ответа OMDb. Возвращает True, если ключ отложен и запрос нужно повторить другим ключом """
+
+        if error in QUOTA_ERRORS:
+            key.exhausted = True
+            self._dirty = True
+            logger.warning('Ключ OMDb исчерпал лимит на сутки', extra={'key': key.label, 'requests': key.requests})
+        elif error in INVALID_KEY_ERRORS:
+            key.parked_until = time.monotonic() + PARK
+            logger.error('Неверный ключ OMDb, отложен на %s с', PARK, extra={'key': key.label})
+        elif status == 429 or status >= 500:
+            key.slow_down()
+            logger.warning('OMDb ответил %s, скорость ключа снижена до %.1f/с', status, key.rate,
+                           extra={'key': key.label})
+            return False
+        else:
+            key.speed_up()
+            return False
+        return True
+
+    async def load(self) -> None:
+        """ Загрузка счетчиков за текущие сутки """
+
+        usage = await async_database.get_omdb_key_usage(today())
+        for key in self.keys:
+            requests, exhausted = usage.get(key.id, (0, False))
+            key.requests = max(key.requests, requests)
+            key.exhausted = key.exhausted or exhausted
+
+    async def flush(self) -> None:
+        """ Сохранение счетчиков, если они изменились """
+
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            await async_database.save_omdb_key_usage([
+                {'key_id': key.id, 'day': key.day, 'requests': key.requests, 'exhausted': key.exhausted}
+                for key in self.keys])
+        except Exception:
+            self._dirty = True
+            raise
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {key.label: {'requests': key.requests, 'rate': key.rate, 'available': key.available(now)}
+                for key in self.keys}
+
+
+def collect_metrics() -> None:
+    """ Перенос счетчиков ключей в метрики перед выгрузкой """
+
+    now = time.monotonic()
+    for key in pool.keys:
+        key_available.labels(key=key.label).set(int(key.available(now)))
+        key_requests.labels(key=key.label).set(key.requests)
+
+
+async def flush_job(context) -> None:
+    """ Задача планировщика: сохранение счетчиков ключей """
+
+    await pool.flush()
+
+
+pool = KeyPool()
@@ -0,0 +1,133 @@
+""" Отправка фильма фотографией постера с подписью.
+    Первый раз Telegram сам загружает постер по ссылке OMDb, file_id загруженной фотографии сохраняется
+    по imdbID в таблице poster_file, и следующие отправки фильма используют его без передачи изображения
+"""
+
+import logging
+from configparser import ConfigParser
+from typing import Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+import async_database
+import metrics
+from cache import LRUCache
+
+config = ConfigParser()
+config.read('config.ini')
+ENABLED = config.getboolean('posters', 'enabled', fallback=True)  # false - только текст, как раньше
+CACHE_SIZE = config.getint('posters', 'cache_size', fallback=5000)
+CACHE_TTL = config.getint('posters', 'cache_ttl', fallback=24 * 3600)
+
+NO_POSTER = ''  # Постер, который Telegram не смог загрузить по ссылке
+
+logger = logging.getLogger(__name__)
+poster_sends = metrics.counter('bot_poster_sends_total', 'Отправки фильма: по file_id, загрузка по ссылке, текстом',
+                               ('source',))
+
+
+def is_photo_error(error: BadRequest) -> bool:
+    """ Ошибка из-за фотографии (ссылка недоступна, file_id устарел), а не из-за чата или подписи """
+
+    message = error.message.lower()
+    return any(word in message for word in ('file', 'url', 'photo', 'image', 'web page content'))
+
+
+def has_poster(poster: Optional[str]) -> bool:
+    return bool(poster) and poster.startswith('http')
+
+
+class PosterStore:
+    """ file_id постеров: кэш в памяти процесса поверх таблицы poster_file """
+
+    def __init__(self, size: int = CACHE_SIZE, ttl: int = CACHE_TTL):
+        self._file_ids = LRUCache(size, ttl)  # imdbID -> file_id или NO_POSTER
+
+    async def get(self, imdb_id: str) -> Optional[str]:
+        """ file_id постера, NO_POSTER или None, если постер еще не загружался или база недоступна """
+
+        file_id = self._file_ids.get(imdb_id)
+        if file_id is None:
+            try:
+                file_id = await async_database.get_poster_file_id(imdb_id)
+            except Exception:
+                logger.warning('Не удалось прочитать file_id постера', exc_info=True, extra={'imdb_id': imdb_id})
+                return None
+            if file_id is not None:
+                self._file_ids.set(imdb_id, file_id)
+        return file_id
+
+    async def set(self, imdb_id: str, file_id: str) -> None:
+        """ Сохранение file_id. Если база недоступна, file_id остается в кэше процесса """
+
+        self._file_ids.set(imdb_id, file_id)
+        try:
+            await async_database.set_poster_file_id(imdb_id, file_id)
+        except Exception:
+            logger.warning('Не удалось сохранить file_id постера', exc_info=True, extra={'imdb_id': imdb_id})
+
+    async def failed(self, imdb_id: str, photo: str, poster: str) -> Optional[str]:
+        """ Постер не отправился. Устаревший file_id удаляется, и постер загружается по ссылке заново,
+            недоступная ссылка больше не используется. Возвращает, что отправить следующим
+        """
+
+        if photo != poster:
+            self._file_ids.pop(imdb_id)
+            try:
+                await async_database.delete_poster_file_id(imdb_id)
+            except Exception:
+                logger.warning('Не удалось удалить file_id постера', exc_info=True, extra={'imdb_id': imdb_id})
+            return poster
+        self._file_ids.set(imdb_id, NO_POSTER)
+        return None
+
+    async def photo(self, imdb_id: str, poster: Optional[str]) -> Optional[str]:
+        """ Что отправлять фотографией: file_id, ссылку на постер для первой загрузки или None - только текст """
+
+        if not ENABLED or not has_poster(poster):
+            return None
+        file_id = await self.get(imdb_id)
+        if file_id == NO_POSTER:
+            return None
+        return file_id or poster
+
+    def stats(self) -> dict:
+        return self._file_ids.stats()
+
+
+async def send_film(bot: Bot, chat_id: int, answer: dict) -> Message:
+    """ Отправка найденного фильма: постер с подписью, если постера нет или он не отправился - текст """
+
+    imdb_id, poster = answer['imdbID'], answer.get('poster')
+    photo = await store.photo(imdb_id, poster)
+    while photo is not None:
+        try:
+            message = await bot.send_photo(chat_id, photo, caption=answer['caption'])
+        except BadRequest as e:
+            if not is_photo_error(e):
+                raise
+            logger.warning('Постер не отправлен: %s', e.message, extra={'imdb_id': imdb_id})
+            photo = await store.failed(imdb_id, photo, poster)
+        else:
+            await remember(imdb_id, photo, message)
+            return message
+    poster_sends.labels(source='text').inc()
+    return await bot.send_message(chat_id, answer['data'])
+
+
+async def remember(imdb_id: str, photo: str, message: Message) -> Optional[str]:
+    """ Сохранение file_id после первой загрузки постера по ссылке. Возвращает file_id отправленной фотографии """
+
+    if not message.photo:
+        return None
+    file_id = message.photo[-1].file_id  # Самый большой размер
+    if photo.startswith('http'):
+        poster_sends.labels(source='upload').inc()
+        await store.set(imdb_id, file_id)
+    else:
+        poster_sends.labels(source='file_id').inc()
+    return file_id
+
+
+store = PosterStore()
@@ -0,0 +1,112 @@
+""" Буфер заранее найденных случайных фильмов для /random_film и рассылки """
+
+import asyncio
+import logging
+from collections import deque
+from configparser import ConfigParser
+from typing import Optional
+
+import api
+
+config = ConfigParser()
+config.read('config.ini')
+LOW_WATERMARK = config.getint('random_film', 'low_watermark', fallback=3)
+HIGH_WATERMARK = config.getint('random_film', 'high_watermark', fallback=10)
+RETRY_BUDGET = config.getint('random_film', 'retry_budget', fallback=20)
+RETRY_DELAY = config.getfloat('random_film', 'retry_delay', fallback=1)
+BUDGET_PAUSE = config.getfloat('random_film', 'budget_pause', fallback=60)
+RECENT_SIZE = config.getint('random_film', 'recent_size', fallback=100)
+
+logger = logging.getLogger(__name__)
+
+
+class RandomFilmBuffer:
+    """ Очередь проверенных случайных фильмов (найден в OMDb, есть постер).
+        Фоновая задача пополняет очередь до high_watermark, когда в ней остается меньше low_watermark,
+        недостающие фильмы ищутся параллельно.
+        Фильмы, выданные недавно или уже стоящие в очереди, повторно не добавляются
+    """
+
+    def __init__(self, low: int = LOW_WATERMARK, high: int = HIGH_WATERMARK, retry_budget: int = RETRY_BUDGET,
+                 retry_delay: float = RETRY_DELAY, budget_pause: float = BUDGET_PAUSE, recent_size: int = RECENT_SIZE):
+        self.low = low
+        self.high = high
+        self.retry_budget = retry_budget
+        self.retry_delay = retry_delay
+        self.budget_pause = budget_pause
+        self._queue = None
+        self._queued = set()  # imdbID фильмов в очереди
+        self._recent = deque(maxlen=recent_size)  # imdbID недавно выданных фильмов
+        self._refill = None
+        self._task = None
+
+    def start(self) -> None:
+        """ Запуск фоновой задачи пополнения """
+
+        self._queue = asyncio.Queue(maxsize=self.high)
+        self._refill = asyncio.Event()
+        self._refill.set()
+        self._task = asyncio.create_task(self._produce())
+
+    async def stop(self) -> None:
+        """ Остановка фоновой задачи """
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get(self) -> Optional[dict]:
+        """ Случайный фильм из очереди. Если очередь пуста - поиск с ограниченным числом попыток """
+
+        film = None
+        if self._queue is not None and not self._queue.empty():
+            film = self._queue.get_nowait()
+            self._queued.discard(film['imdbID'])
+        if self._refill is not None and self._queue.qsize() < self.low:
+            self._refill.set()
+        if film is None:
+            film = await api.get_random_film()
+        if film is not None:
+            self._recent.append(film['imdbID'])
+        return film
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _produce(self) -> None:
+        """ Пополнение очереди до high_watermark """
+
+        while True:
+            try:
+                await self._refill.wait()
+                failures = 0
+                while not self._queue.full():
+                    wanted = self.high - self._queue.qsize()
+                    found = 0
+                    for film in await api.find_random_films(wanted):
+                        if film['imdbID'] in self._queued or film['imdbID'] in self._recent or self._queue.full():
+                            continue
+                        self._queued.add(film['imdbID'])
+                        self._queue.put_nowait(film)
+                        found += 1
+                    if found:
+                        failures = 0
+                        continue
+                    failures += wanted
+                    if failures >= self.retry_budget:
+                        logger.warning('Не удалось пополнить очередь случайных фильмов за %s попыток', failures)
+                        await asyncio.sleep(self.budget_pause)
+                        failures = 0
+                    else:
+                        await asyncio.sleep(self.retry_delay)
+                self._refill.clear()
+            except Exception:  # Например, недоступна база данных. Задача не должна завершаться
+                logger.exception('Ошибка пополнения очереди случайных фильмов')
+                await asyncio.sleep(self.retry_delay)
+
+
+films = RandomFilmBuffer()
@@ -0,0 +1,84 @@
+""" Подсчет запросов пользователей за последние сутки в памяти процесса.
+    Источник истины - таблица request, счетчики загружаются из нее при запуске
+    и периодически сверяются с ней
+"""
+
+from collections import deque
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+
+import async_database
+import request_log
+import whitelist
+
+config = ConfigParser()
+config.read('config.ini')
+WINDOW = config.getint('quota', 'window', fallback=24 * 3600)  # Секунд
+RECONCILE_INTERVAL = config.getint('quota', 'reconcile_interval', fallback=600)
+RING_SIZE = config.getint('quota', 'ring_size', fallback=50)  # Размер кольца, если подписка пользователя неизвестна
+
+
+class SlidingWindow:
+    """ Время последних запросов каждого пользователя в кольцевом буфере.
+        Размер кольца равен лимиту подписки: если кольцо заполнено запросами из окна - лимит исчерпан
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self._rings = {}  # id пользователя -> deque с временем запросов
+
+    def count(self, user_id: int, now: datetime) -> int:
+        """ Количество запросов пользователя за окно """
+
+        ring = self._rings.get(user_id)
+        if ring is None:
+            return 0
+        threshold = now.timestamp() - self.window
+        while ring and ring[0] < threshold:
+            ring.popleft()
+        return len(ring)
+
+    def allow(self, user_id: int, max_request: int, now: datetime) -> bool:
+        """ Можно ли пользователю выполнить еще один запрос """
+
+        return self.count(user_id, now) < max_request
+
+    def add(self, user_id: int, date_time: datetime, max_request: int) -> None:
+        """ Учет успешного запроса """
+
+        ring = self._rings.get(user_id)
+        if ring is None or ring.maxlen < max_request:
+            ring = deque(ring or (), maxlen=max_request)
+            self._rings[user_id] = ring
+        ring.append(date_time.timestamp())
+
+    def replace(self, requests: dict) -> None:
+        """ Замена всех счетчиков: время запросов по id пользователя """
+
+        rings = {}
+        for user_id, dates in requests.items():
+            ring = deque(maxlen=max(_max_request(user_id), len(dates)))
+            ring.extend(sorted(date_time.timestamp() for date_time in dates))
+            rings[user_id] = ring
+        self._rings = rings
+
+    async def load(self) -> None:
+        """ Загрузка счетчиков из таблицы request и еще не записанных запросов.
+            Пока идет загрузка, запись запросов в базу приостановлена, поэтому запрос не учитывается дважды
+        """
+
+        async with request_log.log.paused():
+            since = datetime.now() - timedelta(seconds=self.window)
+            rows = await async_database.requests_since(since)
+            requests = request_log.log.pending()
+        for user_id, date_time in rows:
+            requests.setdefault(user_id, []).append(date_time)
+        self.replace(requests)
+
+
+def _max_request(user_id: int) -> int:
+    info = whitelist.users.get_by_id(user_id)
+    return info.max_request if info is not None else RING_SIZE
+
+
+window = SlidingWindow()
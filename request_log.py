@@ -0,0 +1,163 @@
+""" Отложенная запись запросов пользователей в request и bad_request.
+    Записи копятся в очереди и сохраняются пачками, поэтому ответ пользователю не ждет базу данных
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from configparser import ConfigParser
+from datetime import datetime
+
+import async_database
+
+config = ConfigParser()
+config.read('config.ini')
+BUFFER_SIZE = config.getint('request_log', 'buffer_size', fallback=10000)
+BATCH_SIZE = config.getint('request_log', 'batch_size', fallback=500)
+FLUSH_INTERVAL = config.getfloat('request_log', 'flush_interval', fallback=2)
+MAX_RETRIES = config.getint('request_log', 'max_retries', fallback=5)
+
+logger = logging.getLogger(__name__)
+
+REQUEST = 'request'
+BAD_REQUEST = 'bad_request'
+
+
+class RequestLog:
+    """ Очередь записей request и bad_request.
+        Сохраняется, когда накопилось batch_size записей или прошло flush_interval секунд.
+        Если очередь заполнена, добавление ждет освобождения места.
+        Пачка, не записанная за max_retries попыток, повторяется со следующей и до записи считается в pending
+    """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL, max_retries: int = MAX_RETRIES):
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = None
+        self._task = None
+        self._pending = defaultdict(list)  # id пользователя -> время еще не записанных успешных запросов
+        self._unwritten = []  # Записи пачки, которую не удалось записать
+        self._stopping = False
+        self._flush_lock = asyncio.Lock()
+
+    def start(self) -> None:
+        """ Запуск фоновой записи """
+
+        self._queue = asyncio.Queue(maxsize=self.buffer_size)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ Остановка с записью всего, что осталось в очереди.
+            Если запись не удалась, оставшиеся записи выводятся в журнал
+        """
+
+        if self._task is None:
+            return
+        self._stopping = True
+        if self._queue.empty():
+            self._queue.put_nowait(None)  # Пробуждение ожидающей записи, в полной очереди она не ждет
+        await self._task
+        self._task = None
+
+    async def add_request(self, user_id: int, imdb_id: str, date_time: datetime) -> None:
+        """ Успешный запрос пользователя (id из таблицы user) """
+
+        self._pending[user_id].append(date_time)
+        await self._queue.put((REQUEST, {'user_id': user_id, 'imdbID': imdb_id, 'date_time': date_time}))
+
+    async def add_bad_request(self, user_id: int, title: str, date_time: datetime, error: str) -> None:
+        """ Неуспешный запрос пользователя (id из таблицы user) """
+
+        await self._queue.put((BAD_REQUEST, {'user_id': user_id, 'title': title[:50],
+                                             'date_time': date_time, 'error': error[:200]}))
+
+    def pending(self) -> dict:
+        """ Время успешных запросов, которые еще не записаны в базу, по id пользователя """
+
+        return {user_id: list(dates) for user_id, dates in self._pending.items()}
+
+    def paused(self) -> asyncio.Lock:
+        """ Блокировка, пока она захвачена - запись в базу не выполняется """
+
+        return self._flush_lock
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            items, self._unwritten = self._unwritten, []
+            if not items:
+                if self._stopping and self._queue.empty():
+                    return
+                item = await self._queue.get()
+                if item is None:
+                    continue
+                items = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(items) < self.batch_size:
+                if self._stopping:  # При остановке пачка собирается из того, что уже в очереди, без ожидания
+                    if self._queue.empty():
+                        break
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is not None:
+                    items.append(item)
+            await self._flush(items)
+            if self._stopping and self._unwritten:
+                lost = self._unwritten + [item for item in self._drain() if item is not None]
+                self._unwritten = []
+                logger.error('Запросы не записаны: %s', lost)
+                return
+
+    def _drain(self) -> list:
+        """ Все записи, оставшиеся в очереди """
+
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    async def _flush(self, items: list) -> None:
+        """ Запись пачки одной транзакцией. При ошибке запись повторяется,
+            после max_retries неудачных попыток пачка остается в _unwritten
+        """
+
+        if not items:
+            return
+        requests = [row for kind, row in items if kind == REQUEST]
+        bad_requests = [row for kind, row in items if kind == BAD_REQUEST]
+        last_requests = {}
+        for _, row in items:
+            last_requests[row['user_id']] = max(row['date_time'], last_requests.get(row['user_id'], row['date_time']))
+
+        async with self._flush_lock:
+            for attempt in range(self.max_retries):
+                try:
+                    await async_database.write_request_log(requests, bad_requests, last_requests)
+                    break
+                except Exception as e:
+                    logger.warning('Не удалось записать запросы (%s шт), попытка %s: %r', len(items), attempt + 1, e)
+                    await asyncio.sleep(min(2 ** attempt, 30))
+            else:
+                logger.error('Не удалось записать запросы (%s шт), запись будет повторена', len(items))
+                self._unwritten = items
+                return
+
+            for row in requests:
+                dates = self._pending[row['user_id']]
+                dates.remove(row['date_time'])
+                if not dates:
+                    del self._pending[row['user_id']]
+
+
+log = RequestLog()
@@ -0,0 +1,83 @@
+""" Дневная статистика запросов и удаление старых записей request и bad_request.
+    Запуск из консоли:
+        python rollup.py run - учесть новые записи
+        python rollup.py backfill - пересчитать статистику по существующим записям
+        python rollup.py retention - удалить старые записи, уже учтенные в статистике
+        python rollup.py top [дней] - самые запрашиваемые фильмы
+"""
+
+import logging
+import sys
+from configparser import ConfigParser
+from datetime import date, datetime, timedelta
+
+import async_database
+import database
+import logs
+
+config = ConfigParser()
+config.read('config.ini')
+INTERVAL = config.getint('rollup', 'interval', fallback=3600)
+RETENTION_DAYS = config.getint('rollup', 'retention_days', fallback=0)  # 0 - записи не удаляются
+MIN_RETENTION_DAYS = 2  # Записи за последние сутки нужны для подсчета лимита запросов
+
+logger = logging.getLogger(__name__)
+
+
+def retention_threshold() -> datetime:
+    """ Записи старше этого времени удаляются """
+
+    return datetime.now() - timedelta(days=max(RETENTION_DAYS, MIN_RETENTION_DAYS))
+
+
+def run() -> None:
+    """ Учет новых записей и удаление старых """
+
+    result = database.rollup_requests()
+    logger.info('Статистика обновлена: %s', result)
+    if RETENTION_DAYS:
+        logger.info('Удалено записей: %s', database.delete_old_requests(retention_threshold()))
+
+
+def backfill() -> None:
+    """ Пересчет статистики по существующим записям.
+        Если старые записи уже удалены, статистика за дни без полных записей сохраняется
+    """
+
+    database.create_tables()
+    since = database.complete_requests_since()
+    if since is not None:
+        logger.warning('Старые записи удалены, статистика пересчитывается начиная с %s', since)
+    database.reset_rollups(since)
+    logger.info('Статистика пересчитана: %s', database.rollup_requests(since))
+
+
+async def rollup_job(context) -> None:
+    """ Задача планировщика бота: учет новых записей и удаление старых """
+
+    result = await async_database.run(database.rollup_requests)
+    deleted = None
+    if RETENTION_DAYS:
+        deleted = await async_database.run(database.delete_old_requests, retention_threshold())
+    logger.info('Статистика обновлена: %s', result, extra={'deleted': deleted})
+
+
+def main() -> None:
+    logs.setup()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command == 'run':
+        run()
+    elif command == 'backfill':
+        backfill()
+    elif command == 'retention':
+        logger.info('Удалено записей: %s', database.delete_old_requests(retention_threshold()))
+    elif command == 'top':
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+        for imdb_id, amount in database.top_films(date.today() - timedelta(days=days - 1)):
+            print(f'{imdb_id}: {amount}')
+    else:
+        print(__doc__)
+
+
+if __name__ == '__main__':
+    main()
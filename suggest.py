@@ -0,0 +1,172 @@
+""" Подсказки названий фильмов для inline режима (@бот <название>).
+    Индекс в памяти процесса по всем фильмам, которые бот уже находил: названия OMDb и запросы пользователей,
+    по которым фильм был найден. Загружается из movie_cache и request при запуске
+    и дополняется при каждом найденном фильме, OMDb при подсказках не запрашивается
+"""
+
+from bisect import bisect_left, insort
+from collections import Counter
+from configparser import ConfigParser
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import async_database
+from catalog import normalize_title
+
+config = ConfigParser()
+config.read('config.ini')
+LIMIT = config.getint('suggest', 'limit', fallback=10)  # Telegram показывает до 50 результатов
+MIN_QUERY = config.getint('suggest', 'min_query', fallback=2)  # Символов, с которых начинаются подсказки
+# Совпадений по началу слова, из которых выбираются лучшие
+SCAN_LIMIT = config.getint('suggest', 'scan_limit', fallback=1000)
+# Доля триграмм запроса, которые должны быть в названии
+SIMILARITY = config.getfloat('suggest', 'similarity', fallback=0.4)
+CACHE_TIME = config.getint('suggest', 'cache_time', fallback=60)  # Секунд, сколько Telegram хранит ответ
+
+
+class Suggestion(NamedTuple):
+    imdb_id: str
+    title: str
+    year: Optional[str]
+
+    @property
+    def label(self) -> str:
+        """ Название с годом, как его нужно отправить боту для поиска """
+
+        return f'{self.title} {self.year}' if self.year else self.title
+
+
+def trigrams(normalized: str) -> set:
+    """ Триграммы слов названия, с пробелами по краям, как в pg_trgm """
+
+    grams = set()
+    for word in normalized.split():
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def parse_year(year: Optional[str]) -> Optional[str]:
+    """ Год выпуска из поля Year OMDb: 1999, 2010–2014 """
+
+    year = (year or '')[:4]
+    return year if year.isdigit() else None
+
+
+def _names(key: str) -> tuple:
+    """ Название из ключа кэша. Ключ поиска по imdbID названием не считается """
+
+    name = key.split('|')[0]
+    return () if name.startswith('tt') and name[2:].isdigit() else (name,)
+
+
+class TitleIndex:
+    """ Индекс названий: отсортированный список окончаний названий с начала каждого слова для поиска по началу
+        и триграммы для поиска с опечатками. Среди совпадений выше фильмы, которые чаще запрашивали
+    """
+
+    def __init__(self, limit: int = LIMIT):
+        self.limit = limit
+        self._films: Dict[str, Suggestion] = {}  # imdbID -> фильм
+        self._names = set()  # (нормализованное название, imdbID), уже добавленные в индекс
+        self._keys = []  # отсортированные (окончание названия, imdbID, начало ли это названия)
+        self._trigrams: Dict[str, set] = {}  # триграмма -> imdbID
+        self._popularity = Counter()  # imdbID -> количество успешных запросов
+
+    def __len__(self) -> int:
+        return len(self._films)
+
+    def add(self, imdb_id: str, title: str, year: Optional[str] = None, names: Iterable[str] = (),
+            requests: int = 0) -> None:
+        """ Добавление фильма с названием OMDb и дополнительными названиями, по которым его находили """
+
+        for key in self._update(imdb_id, title, year, names, requests):
+            insort(self._keys, key)
+
+    def add_many(self, films: Iterable[Tuple[str, str, Optional[str], Iterable[str], int]]) -> None:
+        """ Добавление многих фильмов (imdbID, название, год, названия, запросы) с одной сортировкой индекса """
+
+        keys = []
+        for film in films:
+            keys.extend(self._update(*film))
+        self._keys.extend(keys)
+        self._keys.sort()
+
+    def _update(self, imdb_id: str, title: str, year: Optional[str], names: Iterable[str], requests: int) -> list:
+        """ Обновление фильма, возвращает новые ключи для поиска по началу """
+
+        if not imdb_id or not title:
+            return []
+        film = self._films.get(imdb_id)
+        year = parse_year(year) or (film.year if film is not None else None)
+        if film is None or film.title != title or film.year != year:
+            self._films[imdb_id] = Suggestion(imdb_id, title, year)
+        self._popularity[imdb_id] += requests
+        keys = []
+        for name in (title, *names):
+            normalized = normalize_title(name)
+            if not normalized or (normalized, imdb_id) in self._names:
+                continue
+            self._names.add((normalized, imdb_id))
+            words = normalized.split(' ')
+            keys.extend((' '.join(words[i:]), imdb_id, i == 0) for i in range(len(words)))
+            for gram in trigrams(normalized):
+                self._trigrams.setdefault(gram, set()).add(imdb_id)
+        return keys
+
+    def touch(self, imdb_id: str) -> None:
+        """ Учет успешного запроса фильма """
+
+        if imdb_id in self._films:
+            self._popularity[imdb_id] += 1
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Suggestion]:
+        """ Подсказки по началу названия или его слова, если их не хватает - по триграммам """
+
+        limit = limit or self.limit
+        normalized = normalize_title(query)
+        if len(normalized) < MIN_QUERY:
+            return []
+
+        ranks = {}  # imdbID -> (совпадение, популярность), больше - выше
+        keys = self._keys
+        i = bisect_left(keys, (normalized,))
+        end = min(i + SCAN_LIMIT, len(keys))
+        while i < end and keys[i][0].startswith(normalized):
+            _, imdb_id, is_start = keys[i]
+            match = 3 if is_start else 2
+            if ranks.get(imdb_id, (0,))[0] < match:
+                ranks[imdb_id] = (match, self._popularity[imdb_id])
+            i += 1
+
+        if len(ranks) < limit:
+            grams = trigrams(normalized)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self._trigrams.get(gram, ()))
+            for imdb_id, count in shared.items():
+                similarity = count / len(grams)
+                if imdb_id not in ranks and similarity >= SIMILARITY:
+                    ranks[imdb_id] = (similarity, self._popularity[imdb_id])
+
+        best = sorted(ranks, key=ranks.__getitem__, reverse=True)[:limit]
+        return [self._films[imdb_id] for imdb_id in best]
+
+    async def load(self) -> None:
+        """ Заполнение индекса фильмами из movie_cache, популярность - по таблице request """
+
+        rows = await async_database.cached_titles()
+        requests = await async_database.request_counts()
+        self.add_many((imdb_id, title, year, _names(key), 0) for imdb_id, key, title, year in rows)
+        for imdb_id, count in requests.items():
+            self._popularity[imdb_id] += count
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._films),
+            'names': len(self._names),
+            'keys': len(self._keys),
+            'trigrams': len(self._trigrams),
+        }
+
+
+titles = TitleIndex()
@@ -0,0 +1,72 @@
+""" Параллельная обработка обновлений с сохранением порядка внутри одного чата """
+
+import asyncio
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+UNLIMITED = 2 ** 16
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """ Обновления разных чатов обрабатываются параллельно, не больше max_concurrent_updates одновременно.
+        Обновления одного чата обрабатываются по очереди в порядке поступления.
+
+        Общий лимит применяется после очереди чата: иначе обновления одного чата, ожидающие
+        своей очереди, занимали бы места, нужные другим чатам. Поэтому базовому классу передается
+        UNLIMITED, а лимит хранится в собственном семафоре
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        self._limit = max_concurrent_updates
+        super().__init__(UNLIMITED)
+        self._concurrency = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        self._chat_waiters = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._concurrency:
+                await coroutine
+            return
+
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+            self._chat_waiters[chat_id] = 0
+        self._chat_waiters[chat_id] += 1
+        try:
+            async with lock:  # asyncio.Lock пропускает ожидающих в порядке очереди
+                async with self._concurrency:
+                    await coroutine
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        """ Чат обновления. Для обновлений без чата - пользователь.
+            Инлайн-запросы не упорядочиваются: они не меняют состояние, а ответ на устаревший Telegram отбрасывает
+        """
+
+        if not isinstance(update, Update) or update.inline_query is not None:
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
@@ -0,0 +1,111 @@
+""" Работа бота через вебхук вместо long polling.
+    Обновления принимает встроенный HTTP сервер aiohttp и передает их в Application,
+    все обработчики остаются прежними. Процесс бота один (см. database.acquire_instance_lock),
+    метрики отдает отдельный сервер из раздела [metrics], а не публичный сервер вебхука
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from configparser import ConfigParser
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+config = ConfigParser()
+config.read('config.ini')
+URL = config.get('webhook', 'url', fallback='')  # Публичный адрес, пусто - вебхук в Telegram не регистрируется
+LISTEN = config.get('webhook', 'listen', fallback='0.0.0.0')
+PORT = config.getint('webhook', 'port', fallback=8080)
+PATH = config.get('webhook', 'path', fallback='/telegram')
+SECRET_TOKEN = config.get('webhook', 'secret_token', fallback='')
+DRAIN_TIMEOUT = config.getfloat('webhook', 'drain_timeout', fallback=30)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(application: Application, secret_token: str = SECRET_TOKEN, path: str = PATH) -> web.Application:
+    """ HTTP приложение: прием обновлений и проверка работоспособности """
+
+    state = {'draining': False}
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), secret_token.encode()):
+            return web.Response(status=403)
+        if state['draining']:
+            return web.Response(status=503)  # Telegram повторит отправку позже
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        status = 503 if state['draining'] or not application.running else 200
+        return web.json_response({'running': application.running,
+                                  'draining': state['draining'],
+                                  'queue': application.update_queue.qsize()},
+                                 status=status)
+
+    app = web.Application()
+    app['state'] = state
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/health', health)
+    return app
+
+
+async def serve(application: Application) -> None:
+    """ Запуск бота с вебхуком до получения SIGINT или SIGTERM.
+        При остановке сервер перестает принимать обновления, после чего
+        Application обрабатывает все уже принятые
+    """
+
+    if not SECRET_TOKEN:
+        raise ValueError('Для работы через вебхук укажите secret_token в разделе [webhook] config.ini')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    app = create_app(application)
+    runner = web.AppRunner(app, shutdown_timeout=DRAIN_TIMEOUT)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if URL:
+            await application.bot.set_webhook(url=URL.rstrip('/') + PATH,
+                                              secret_token=SECRET_TOKEN,
+                                              allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, LISTEN, PORT).start()
+        logger.info('Вебхук слушает %s:%s%s', LISTEN, PORT, PATH)
+
+        await stop.wait()
+        logger.info('Остановка: новые обновления не принимаются, обрабатываются принятые')
+        app['state']['draining'] = True
+        await runner.cleanup()  # Ждет завершения начатых HTTP запросов
+        await application.stop()  # Ждет обработки всех обновлений из очереди
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application: Application) -> None:
+    """ Запуск бота с вебхуком """
+
+    asyncio.run(serve(application))
@@ -0,0 +1,111 @@
+""" Кэш белого листа и подписок пользователей.
+    Белый лист меняется только при /activate, поэтому проверки пользователя
+    выполняются без запросов к базе данных. Пользователи не из белого листа
+    запоминаются на negative_ttl секунд, чтобы их сообщения и inline запросы не проверялись в базе каждый раз
+"""
+
+from configparser import ConfigParser
+from typing import NamedTuple, Optional
+
+import async_database
+from cache import LRUCache
+
+config = ConfigParser()
+config.read('config.ini')
+NEGATIVE_SIZE = config.getint('whitelist', 'negative_size', fallback=10000)
+NEGATIVE_TTL = config.getint('whitelist', 'negative_ttl', fallback=60)
+
+
+class UserInfo(NamedTuple):
+    """ Данные пользователя из белого листа """
+
+    id: int  # id из таблицы user
+    subscription: int
+    name: str  # Название подписки
+    max_request: int
+    mailing: bool
+
+
+class Whitelist:
+    """ Соответствие telegram id пользователю и его подписке """
+
+    def __init__(self, negative_size: int = NEGATIVE_SIZE, negative_ttl: int = NEGATIVE_TTL):
+        self._users = {}
+        self._by_id = {}  # id из таблицы user -> данные пользователя
+        self._unknown = LRUCache(negative_size, negative_ttl)  # telegram id пользователей не из белого листа
+        self._subscriptions = None
+        self.hits = 0
+        self.misses = 0
+
+    async def warm(self) -> None:
+        """ Загрузка всего белого листа и подписок из базы данных """
+
+        rows = await async_database.get_all_users_info()
+        self._users = {telegram_id: UserInfo(*info) for telegram_id, *info in rows}
+        self._by_id = {info.id: info for info in self._users.values()}
+        self._subscriptions = await async_database.view_all_sub()
+
+    async def get(self, telegram_id: int) -> Optional[UserInfo]:
+        """ Информация о пользователе или None, если его нет в белом листе """
+
+        info = self._users.get(telegram_id)
+        if info is not None or self._unknown.get(telegram_id) is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        return await self.refresh(telegram_id)
+
+    async def refresh(self, telegram_id: int) -> Optional[UserInfo]:
+        """ Обновление пользователя из базы данных. Вызывается после /activate и смены подписки """
+
+        row = await async_database.get_user_info(telegram_id)
+        if row is None:
+            info = self._users.pop(telegram_id, None)
+            if info is not None:
+                self._by_id.pop(info.id, None)
+            self._unknown.set(telegram_id, True)
+            return None
+        self._unknown.pop(telegram_id)
+        info = UserInfo(*row)
+        self._users[telegram_id] = info
+        self._by_id[info.id] = info
+        return info
+
+    def get_by_id(self, user_id: int) -> Optional[UserInfo]:
+        """ Информация о пользователе по id из таблицы user, только из кэша """
+
+        return self._by_id.get(user_id)
+
+    def set_mailing(self, telegram_id: int, mailing: bool) -> None:
+        """ Обновление статуса рассылки после /on_off_mailing """
+
+        info = self._users.get(telegram_id)
+        if info is not None:
+            info = info._replace(mailing=mailing)
+            self._users[telegram_id] = info
+            self._by_id[info.id] = info
+
+    async def subscriptions(self) -> dict:
+        """ Все доступные подписки """
+
+        if self._subscriptions is None:
+            self.misses += 1
+            self._subscriptions = await async_database.view_all_sub()
+        else:
+            self.hits += 1
+        return self._subscriptions
+
+    def stats(self) -> dict:
+        """ Счетчики кэша """
+
+        total = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'unknown': len(self._unknown),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+users = Whitelist()